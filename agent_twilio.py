@@ -1,25 +1,30 @@
 import asyncio
-import base64
 import json
-import os, wave, io
+import os
 import signal
 import time
 import functools
-import audioop
-import webrtcvad
+from collections import deque
+from contextlib import aclosing
 from fastapi import FastAPI, WebSocket, Request
 from fastapi.responses import Response
-import elevenlabs
-from elevenlabs.client import ElevenLabs
 from dotenv import load_dotenv
 from fastapi import HTTPException, Depends
-from elevenlabs import VoiceSettings
 from starlette.websockets import WebSocketDisconnect
-from twilio.rest import Client
+from codec import PCM_FRAME_BYTES, SAMPLE_RATE, decode_payload, frames, media_message, pad_frame, parse_message, pcm_to_ulaw
+from listener import Listener
+from metrics import Metrics, summarize_turns
+from providers import make_http_client, make_speech_provider, make_twilio_calls
+from recording import make_recorder
+from relay import make_relay
+from endpointing import DISCARD, ENDPOINT, SILENCE, SPEECH, SPEECH_START, EndpointConfig
+from sessions import AWAITING_MARK, CONVERSATION_ENDED, ENDED, LISTENING, SPEAKING, TRANSCRIBING, SessionRegistry
+from tts_cache import make_tts_cache
 
 app = FastAPI()
 load_dotenv()
 
+
 async def verify_api_key(request: Request):
     """
     A dependency to verify the X-API-KEY header.
@@ -31,36 +36,107 @@ async def verify_api_key(request: Request):
             detail="Invalid or missing API Key."
         )
 
-    
-def reset_app_state():
-    """Resets the global application state to its default values for a new call."""
-    app.state.active = "agent"  # agent or user
-    app.state.transcription = None
-    app.state.transcription_event = asyncio.Event()
-    app.state.input = None
-    app.state.input_event = asyncio.Event()
-    app.state.first_ = True
-    app.state.mark_found = False
-    app.state.time_since_last_talk = time.time()
-    app.state.SHUTDOWN_EVENT = asyncio.Event()
-    app.state.sid = None
 
 @app.on_event("startup")
 async def startup():
     """Initializes global constants and sets the initial state."""
-    app.state.SAMPLE_RATE = 8000
-    app.state.SILENCE_CHUNKS_TRIGGER = 140
+    app.state.SAMPLE_RATE = SAMPLE_RATE
+    app.state.ENDPOINTING = EndpointConfig()  # default end-of-turn detection, overridable per call
     app.state.SECRET_KEY = os.getenv("API_KEY")
     app.state.talk_timeout = 50.0
-    app.state.account_sid = os.environ["TWILIO_ACCOUNT_SID"]
-    app.state.auth_token = os.environ["TWILIO_AUTH_TOKEN"]
-    app.state.client = Client(app.state.account_sid, app.state.auth_token)
+    app.state.streamless_ttl = float(os.getenv("STREAMLESS_SESSION_TTL", 180))  # sessions Twilio never streamed
+    app.state.sessions = SessionRegistry()
+    app.state.metrics = Metrics()
+    app.state.signal_handlers_installed = False
+    app.state.twilio = make_twilio_calls()
+    app.state.http = make_http_client()  # pooled keep-alive connections shared by all calls
+    app.state.speech = make_speech_provider(http_client=app.state.http)
+    app.state.speech_warm_up = asyncio.create_task(app.state.speech.warm_up())
+    app.state.tts_cache = make_tts_cache()  # synthesized user turns, None when disabled
+    app.state.recorder = make_recorder()  # call recordings, None unless RECORDINGS_DIR is set
+    app.state.loop_lag = deque(maxlen=50)  # event loop lag samples (seconds), one every 0.1 s
+    app.state.loop_monitor = asyncio.create_task(monitor_loop_lag())
+    app.state.session_reaper = asyncio.create_task(reap_sessions())
+    app.state.relay = make_relay()  # None unless several workers share a session store
+    if app.state.relay is not None:
+        app.state.relay.start(serve_forwarded_turn)
+        print(f"Relaying turns as worker {app.state.relay.worker_id}")
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.loop_monitor.cancel()
+    app.state.session_reaper.cancel()
+    app.state.speech_warm_up.cancel()
+    app.state.twilio.close()
+    await app.state.http.aclose()
+    if app.state.relay is not None:
+        await app.state.relay.stop()
+    if app.state.recorder is not None:
+        # Lets the writer thread finish the recordings already queued
+        await asyncio.to_thread(app.state.recorder.shutdown)
+
+
+async def monitor_loop_lag(interval=0.1):
+    """
+    Measures how late the event loop wakes up a sleeping task. A blocked loop
+    delays every call's media frames, so this is the first thing to look at
+    when calls stall under load.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        app.state.loop_lag.append(max(0.0, loop.time() - start - interval))
+
+
+async def reap_sessions(interval=10.0):
+    """
+    Only media_stream removes sessions, so one created by /twilio-voice,
+    /generate or /turns for a call whose stream never connects would stay
+    forever. Expire those after STREAMLESS_SESSION_TTL seconds.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        app.state.sessions.expire(app.state.streamless_ttl)
+
+
+def signal_handler(sig=None, previous=None):
+    """Ends every call handled by this process, then lets the server's own handler run."""
+    print("Signal handler called")
+    for session in app.state.sessions.all():
+        session.shutdown()
+    if callable(previous):
+        # uvicorn's handler, so SIGINT/SIGTERM still stop the server
+        previous(sig, None)
+
+
+def install_signal_handlers():
+    """Registers signal_handler once per process, shared by all calls."""
+    if app.state.signal_handlers_installed:
+        return
+    loop = asyncio.get_running_loop()
+    try:
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, signal_handler, sig, signal.getsignal(sig))
+    except (NotImplementedError, RuntimeError, ValueError) as e:
+        print(f"Could not install signal handlers: {e}")
+    app.state.signal_handlers_installed = True
 
 
-def signal_handler():
-    if not app.state.SHUTDOWN_EVENT.is_set():
-        app.state.SHUTDOWN_EVENT.set()
-        print("Signal handler called")
+async def cached_speech(speech, text):
+    """
+    Looks `text` up in the TTS cache. Returns the cached u-law audio (or None)
+    and the key to store it under (None when it can't be cached).
+    """
+    cache = app.state.tts_cache
+    voice = speech.voice_key()
+    if cache is None or voice is None:
+        return None, None
+    key = cache.key(text, voice)
+    audio = await cache.get(key)
+    app.state.metrics.inc("tts_cache_hits_total" if audio is not None else "tts_cache_misses_total")
+    return audio, key
 
 
 @app.post("/twilio-voice")
@@ -69,6 +145,11 @@ async def twilio_voice(request: Request):
     Receives the initial call event from Twilio and responds with TwiML
     to start a media stream.
     """
+    form = await request.form()
+    call_sid = form.get("CallSid")
+    if call_sid and app.state.relay is None and not app.state.sessions.ended(call_sid):
+        # With several workers the session lives where the media stream lands
+        app.state.sessions.get_or_create(call_sid, talk_timeout=app.state.talk_timeout, endpointing=app.state.ENDPOINTING)
     twiml = (
         '<Response>'
         '<Connect>'
@@ -89,242 +170,615 @@ async def media_stream(ws: WebSocket):
     """
     await ws.accept()
     stream_sid = None
+    session = None
+    session_ready = asyncio.Event()
     print("WebSocket connection established with Twilio")
-    audio_buffer = bytearray()
-    api_key_gal = os.getenv("ELEVENLABS_API_KEY_GAL")
-    elevenlabs_client = ElevenLabs(api_key=api_key_gal)
-    user_response = ""
-    timeout = 50.0
+    speech = app.state.speech
+    recorder = app.state.recorder
+    stt_tasks = set()
+
+    async def end_call(reason):
+        """Tears down the call session and hangs up the Twilio call."""
+        session.end()
+        app.state.sessions.remove(session.call_sid)
+        print(reason)
+        await app.state.twilio.hangup(session.call_sid)
+
+    async def transcribe_utterance(utterance, pending):
+        """Waits for the final S2T result in the background so the media loop keeps reading frames."""
+        try:
+            text = await pending
+        except asyncio.CancelledError:
+            pending.cancel()
+            utterance.cancel()
+            raise
+        except Exception as e:
+            utterance.cancel()
+            app.state.metrics.inc("stt_errors_total")
+            print(f"Error calling S2T: {e!r}")
+            if session.state == TRANSCRIBING:
+                session.transition(LISTENING)
+            return
+        print("Agent:", text)
+        session.mark("stt_response", overwrite=True)
+        if recorder is not None:
+            recorder.event(session.call_sid, "agent", text=text)
+        session.publish_transcript(text)
+
+    async def barge_in(time_since_start_sec):
+        """The agent talks over our reply: Twilio drops the queued audio and we listen right away."""
+        if not session.interrupt():
+            return
+        print(f"[{time_since_start_sec:.2f}s] --- Barge-in! Clearing playback. ---")
+        app.state.metrics.inc("barge_ins_total")
+        app.state.metrics.observe_turn(session.finish_turn())
+        session.mark("speech_start")
+        clear = {"event": "clear", "streamSid": stream_sid}
+        await ws.send_json(clear)
+        if recorder is not None:
+            recorder.message(session.call_sid, clear, outbound=True)
+            recorder.clear(session.call_sid)
+            recorder.event(session.call_sid, "barge_in")
 
     async def receive_from_twilio():
         """
         Recieves the audio from twilio through the websocket
         """
-        nonlocal stream_sid, audio_buffer, elevenlabs_client
-        vad = webrtcvad.Vad()
-        vad.set_mode(3)  # 3 is most aggressive
-        silence_counter = 0
-        speech_detected = False
-        current_state = None  # To print state changes only once
-
-        async for raw_msg in ws.iter_text():
-            
-            msg = json.loads(raw_msg)
-            evt = msg["event"]  # start, media, stop, mark 
-            time_since_last_talk = time.time() - app.state.time_since_last_talk
-            if evt == "stop" or (time_since_last_talk >= app.state.talk_timeout) or app.state.SHUTDOWN_EVENT.is_set():
-                signal_handler()
-                app.state.transcription = "Conversation ended by Twilio"
-                app.state.transcription_event.set()
-                if time_since_last_talk >= app.state.talk_timeout:
-                    print("Stream stopped by the talk timeout and ws closed",msg)
-                    await ws.close()
-                app.state.client.calls(f"{app.state.sid}").update(status='completed')
-                print("Stream stopped by Twilio",time_since_last_talk)
+        nonlocal stream_sid, session
+        listener = None  # VAD, endpointing and transcription of the agent's audio
 
-            elif app.state.active == "agent" and ( app.state.first_ or evt == "mark" or app.state.mark_found ):
-
-                if evt == "mark":
-                    mark = msg.get("mark", {}).get("name")
-                    if mark == "endOfPlayback":
-                        app.state.mark_found = True
+        try:
+            async for raw_msg in ws.iter_text():
+            
+                msg = parse_message(raw_msg)
+                evt = msg["event"]  # connected, start, media, stop, mark 
                 if evt == "start":
                     stream_sid = msg["start"]["streamSid"]
-                    print(f"Stream started: {stream_sid}")
+                    call_sid = msg["start"]["callSid"]
+                    session = app.state.sessions.get_or_create(call_sid, talk_timeout=app.state.talk_timeout, endpointing=app.state.ENDPOINTING)
+                    app.state.sessions.bind_stream(session, stream_sid)
+                    app.state.metrics.inc("calls_total")
+                    if app.state.relay is not None:
+                        # Other workers forward this call's turns here from now on
+                        await app.state.relay.claim(call_sid)
+                    if recorder is not None:
+                        recorder.open(call_sid, stream_sid=stream_sid)
+                        recorder.message(call_sid, raw_msg)
+                    session_ready.set()
+                    print(f"Stream started: {stream_sid} (call {call_sid})")
+                    continue
+                if session is None:
+                    continue
+                if recorder is not None:
+                    if evt == "media":
+                        # Queued as received, the writer thread decodes it
+                        recorder.inbound(session.call_sid, msg["media"]["timestamp"], msg["media"]["payload"])
+                    else:
+                        recorder.message(session.call_sid, raw_msg)
+
+                time_since_last_talk = time.time() - session.time_since_last_talk
+                if evt == "stop" or (time_since_last_talk >= session.talk_timeout) or session.shutdown_event.is_set():
+                    if time_since_last_talk >= session.talk_timeout:
+                        await end_call(f"Stream stopped by the talk timeout and ws closed {msg}")
+                        await ws.close()
+                    else:
+                        await end_call(f"Stream stopped by Twilio {time_since_last_talk}")
+                    break
+
+                elif evt == "mark":
+                    mark = msg.get("mark", {}).get("name")
+                    if mark == "endOfPlayback" and session.state == AWAITING_MARK:
+                        # Our audio finished playing, the agent's turn starts now
+                        session.mark("playback_mark")
+                        app.state.metrics.observe_turn(session.finish_turn())
+                        session.transition(LISTENING)
+                        if listener is not None and listener.endpointer.in_utterance:
+                            # The agent started talking (below the barge-in threshold) before playback ended
+                            session.mark("speech_start")
+
+                elif evt == "media" and not (session.listening or session.barge_in and session.playing):
+                    # Audio outside the agent's turn is ignored
+                    if listener is not None:
+                        listener.reset()
+
                 elif evt == "media":
-                    audio_b64 = msg["media"]["payload"]
-                    audio_bytes = base64.b64decode(audio_b64)
                     presentation_timestamp = msg["media"]["timestamp"]
                     time_since_start_sec = float(presentation_timestamp) / 1000.0
 
                     # Twilio sends u-law audio, VAD needs linear PCM
-                    pcm_audio = audioop.ulaw2lin(audio_bytes, 2)
-
-                    try:
-                        is_speech = vad.is_speech(pcm_audio, sample_rate=app.state.SAMPLE_RATE)
-
-                        if is_speech:
-                            if current_state != "speech":
-                                print(f"[{time_since_start_sec:.2f}s] Speech detected.")
-                                current_state = "speech"
-                            speech_detected = True
-                            silence_counter = 0
-                            # Append audio only when speech is detected
-                            audio_buffer.extend(pcm_audio)
-                        
-                        elif speech_detected: # This is a silence chunk immediately following speech
-                            
-                            if current_state != "silence":
-                                print(f"[{time_since_start_sec:.2f}s] Silence detected.")
-                                current_state = "silence"
-                            silence_counter += 1
-                            audio_buffer.extend(pcm_audio) # to include silence in the buffer for sinding to ElevenLabs.
-                            # Trigger AI after a sufficient period of silence 
-                            if silence_counter >= app.state.SILENCE_CHUNKS_TRIGGER:
-
-                                print(f"[{time_since_start_sec:.2f}s] --- End of speech detected! Triggering S2T. ---")
-                                # Note: The audio_buffer is 8kHz, 16-bit PCM.
-                                if audio_buffer:
-                                    # timestamp = int(time.time())
-                                    # filename = os.path.join('./', f"recording_{timestamp}.wav")
-                                    try:
-                                        # with wave.open(filename, 'wb') as wf:
-                                        #     wf.setnchannels(1)  # Mono audio
-                                        #     wf.setsampwidth(2)  # 16-bit samples (2 bytes)
-                                        #     wf.setframerate(SAMPLE_RATE) # 8000 Hz
-                                        #     wf.writeframes(bytes(audio_buffer))
-                                        with io.BytesIO() as wav_buffer:
-                                            with wave.open(wav_buffer, 'wb') as wf:
-                                                wf.setnchannels(1)
-                                                wf.setsampwidth(2)
-                                                wf.setframerate(app.state.SAMPLE_RATE)
-                                                wf.writeframes(bytes(audio_buffer))
-                                            audio_data = wav_buffer.getvalue()
-                                    except Exception as e:
-                                        print(f"Error saving WAV file to buffer: {e}")
-                                    try:
-                                        print(f"Sending {len(audio_buffer)} bytes to ElevenLabs.")
-                                        
-                                        transcription = elevenlabs_client.speech_to_text.convert(
-                                            file=audio_data, 
-                                            model_id="scribe_v1",
-                                            language_code="es",
-                                        )
-                                        print("Agent:", transcription.text)
-                                        if app.state.active == "agent":
-                                            
-                                            app.state.transcription =  transcription.text
-                                            app.state.transcription_event.set() 
-                                            
-                                        
-                                    except Exception as e:
-                                        print(f"Error calling ElevenLabs: {e}")
-                                    
-                                        
-                                
-                                # Reset state for the next utterance
-                                speech_detected = False
-                                silence_counter = 0
-                                current_state = None
-                                audio_buffer.clear()
-
-                    except Exception as e:
-                        print(f"Error processing VAD: {e}")
-
-            
-
+                    pcm_audio = decode_payload(msg["media"]["payload"])
+
+                    if listener is None:
+                        listener = Listener(speech, session.endpointing, sample_rate=app.state.SAMPLE_RATE)
+                    elif listener.config is not session.endpointing:
+                        # /generate may configure the call after the agent started talking
+                        listener.config = session.endpointing
+                    event = listener.process(pcm_audio, incremental=session.stream_stt)
+                    endpointer = listener.endpointer
+                    if session.playing and endpointer.in_utterance and endpointer.speech_ms() >= endpointer.config.barge_in_ms:
+                        await barge_in(time_since_start_sec)
+
+                    if event == SPEECH_START:
+                        print(f"[{time_since_start_sec:.2f}s] Speech detected.")
+                        if session.listening:
+                            session.mark("speech_start")
+                    elif event == SPEECH:
+                        print(f"[{time_since_start_sec:.2f}s] Speech detected.")
+                    elif event == SILENCE:
+                        print(f"[{time_since_start_sec:.2f}s] Silence detected.")
+                        if session.listening:
+                            session.mark("speech_end", overwrite=True)
+
+                    if listener.utterance is None:
+                        continue
+
+                    if event in (ENDPOINT, DISCARD) and session.playing:
+                        print(f"[{time_since_start_sec:.2f}s] Speech during playback too short to barge in, ignored.")
+                        listener.cancel()
+                    elif event == ENDPOINT:
+                        if endpointer.forced:
+                            print(f"[{time_since_start_sec:.2f}s] --- Maximum utterance length reached! Flushing to S2T. ---")
+                            session.mark("speech_end", overwrite=True)
+                        else:
+                            print(f"[{time_since_start_sec:.2f}s] --- End of speech detected! Finishing S2T. ---")
+                        session.mark("endpoint", overwrite=True)
+                        session.transition(TRANSCRIBING)
+                        utterance = listener.take()
+                        pending = utterance.finish()
+                        if utterance.speculations:
+                            # S2T started at a pause before the endpoint, see EndpointConfig.speculative_ms
+                            app.state.metrics.inc("stt_speculations_total", utterance.speculations)
+                            app.state.metrics.inc("stt_speculative_commits_total", utterance.committed)
+                        task = asyncio.create_task(transcribe_utterance(utterance, pending))
+                        for stt_task in (pending, task):
+                            stt_tasks.add(stt_task)
+                            stt_task.add_done_callback(stt_tasks.discard)
+                    elif event == DISCARD:
+                        print(f"[{time_since_start_sec:.2f}s] Utterance too short, discarded.")
+                        if session.state == LISTENING:
+                            # Noise, the turn starts with the next real utterance
+                            session.turn_marks.clear()
+                        listener.cancel()
+        finally:
+            if listener is not None:
+                listener.cancel()
+            # Unblock send_to_twilio and /generate even if the stream never started
+            if session is not None:
+                session.end()
+            session_ready.set()
+
+
+    async def send_media(mulaw_bytes):
+        """Sends u-law audio to Twilio as one media message."""
+        session.mark("first_frame_sent")
+        await ws.send_text(media_message(stream_sid, mulaw_bytes))
+        if recorder is not None:
+            recorder.outbound(session.call_sid, mulaw_bytes)
+
+    async def stream_speech(text):
+        """
+        Forwards TTS audio to Twilio in 20 ms u-law frames as soon as each
+        chunk arrives, so playback starts with the first synthesized chunk.
+        """
+        audio, cache_key = await cached_speech(speech, text)
+        if audio is not None:
+            session.mark("tts_first_byte")
+            for frame in frames(audio):
+                if session.state != SPEAKING:
+                    return  # barge-in
+                await send_media(frame)
+            return
+
+        pending = bytearray()
+        sent = bytearray()  # the whole utterance, cached once synthesis completes
+        complete = False
+        try:
+            async with aclosing(speech.synthesize(text)) as chunks:
+                async for chunk in chunks:
+                    session.mark("tts_first_byte")
+                    pending.extend(chunk)
+                    ready = len(pending) - len(pending) % PCM_FRAME_BYTES
+                    if not ready:
+                        continue
+                    with memoryview(pending) as view:
+                        mulaw_bytes = pcm_to_ulaw(view[:ready])
+                    del pending[:ready]
+                    sent.extend(mulaw_bytes)
+                    for frame in frames(mulaw_bytes):
+                        if session.state != SPEAKING:
+                            return  # barge-in, stop synthesizing too
+                        await send_media(frame)
+            complete = True
+        except (WebSocketDisconnect, RuntimeError):
+            raise
+        except Exception as e:
+            app.state.metrics.inc("tts_errors_total")
+            print(f"Error calling ElevenLabs TTS: {e!r}")
+        if pending:
+            # Pad the trailing partial frame with silence
+            mulaw_bytes = pcm_to_ulaw(pad_frame(pending))
+            sent.extend(mulaw_bytes)
+            await send_media(mulaw_bytes)
+        if complete and cache_key is not None:
+            await app.state.tts_cache.put(cache_key, bytes(sent))
+
+    async def send_speech(text):
+        """Synthesizes the whole utterance and sends it as a single media message."""
+        audio, cache_key = await cached_speech(speech, text)
+        if audio is not None:
+            session.mark("tts_first_byte")
+            if session.state != SPEAKING:
+                return  # barge-in
+            await send_media(audio)
+            return
+
+        audio_buffer_response = bytearray()
+        complete = False
+        try:
+            async for chunk in speech.synthesize(text):
+                session.mark("tts_first_byte")
+                audio_buffer_response.extend(chunk)
+            complete = True
+        except Exception as e:
+            app.state.metrics.inc("tts_errors_total")
+            print(f"Error calling ElevenLabs TTS: {e!r}")
+        if audio_buffer_response:
+            audio = pcm_to_ulaw(pad_frame(audio_buffer_response))
+            if complete and cache_key is not None:
+                await app.state.tts_cache.put(cache_key, audio)
+            if session.state != SPEAKING:
+                return  # barge-in during synthesis, the agent already heard the clear
+            await send_media(audio)
 
     async def send_to_twilio():
         """Handles outbound messages to Twilio's media stream."""
-        nonlocal stream_sid, user_response, timeout, elevenlabs_client
-
-        # Wait until the stop flag is set to True
-        while not app.state.SHUTDOWN_EVENT.is_set():
-            if app.state.active == "user":
-                
-                await asyncio.wait_for(app.state.input_event.wait(), timeout=timeout)
-                app.state.input_event = asyncio.Event()
-                user_response = app.state.input
-
-                response = elevenlabs_client.text_to_speech.convert(
-                    voice_id="5IDdqnXnlsZ1FCxoOFYg",  output_format="pcm_8000", text=user_response,  model_id="eleven_flash_v2_5",language_code="es" ,
-                    voice_settings=VoiceSettings( stability=0.0, similarity_boost=1.0, style=1.0, use_speaker_boost=True, speed=1.0, ), )
-                audio_buffer_response = b''
-                CHUNK_BYTES = 8000
-                audio_buffers = b''
-                for chunk in response:
-                    if chunk:
-                        audio_buffers += chunk
-                        while len(audio_buffers) >= CHUNK_BYTES:
-                            current_chunk = audio_buffers[:CHUNK_BYTES]
-                            audio_buffers = audio_buffers[CHUNK_BYTES:]
-                            # model.feed_audio(current_chunk)
-                            audio_buffer_response+=current_chunk
-                            # time.sleep(0.25)
-                if audio_buffers:
-                    audio_buffer_response+=audio_buffers
-                mulaw_bytes = audioop.lin2ulaw(audio_buffer_response, 2)  # width=2 for 16-bit PCM
-                b64_payload = base64.b64encode(mulaw_bytes).decode('ascii') 
-                
-                audio_delta = {
-                    "event": "media",
+        nonlocal stream_sid, session
+
+        await session_ready.wait()
+        if session is None:
+            return
+        while True:
+            # Wakes up as soon as /generate queues a reply (or None on shutdown)
+            user_response = await session.inputs.get()
+            if user_response is None or session.shutdown_event.is_set():
+                break
+            if recorder is not None:
+                recorder.event(session.call_sid, "user", text=user_response)
+            try:
+                if session.stream_tts:
+                    await stream_speech(user_response)
+                else:
+                    await send_speech(user_response)
+                if session.state != SPEAKING:
+                    print(f"User (interrupted): {user_response}")
+                    continue
+                # Listen again once Twilio reports that our audio finished playing
+                session.transition(AWAITING_MARK)
+                mark = {
+                    "event": "mark",
                     "streamSid": stream_sid,
-                    "media": {
-                        "payload": b64_payload
+                    "mark": {
+                        "name": "endOfPlayback"
                     }
-                }
-                try:
-                    await ws.send_json(audio_delta)
-                except (WebSocketDisconnect, RuntimeError) as e:
-                    print(f"Send failed (media). Assuming websocket closed: {e}")
-                    signal_handler()
-                    break
-                
-                # after this send a mark to the twilio to show that the audio has sopped playing at client side
-                try:
-                    await ws.send_json({
-                        "event": "mark",
-                        "streamSid": stream_sid,
-                        "mark": {
-                            "name": "endOfPlayback"
-                        }
-                        })
-                except (WebSocketDisconnect, RuntimeError) as e:
-                    print(f"Send failed (mark). Assuming websocket closed: {e}")
-                    signal_handler()
-                    break
-                print(f"User: {user_response}")
-                app.state.active = "agent"
-                
-            await asyncio.sleep(0.2)
+                    }
+                await ws.send_json(mark)
+                if recorder is not None:
+                    recorder.message(session.call_sid, mark, outbound=True)
+            except (WebSocketDisconnect, RuntimeError) as e:
+                print(f"Send failed. Assuming websocket closed: {e}")
+                session.end()
+                break
+            print(f"User: {user_response}")
 
 
     try:
-        loop = asyncio.get_running_loop()
-
-        for sig in (signal.SIGTERM, signal.SIGINT):
-            loop.add_signal_handler(sig, signal_handler)
-
+        install_signal_handlers()
         await asyncio.gather(receive_from_twilio(), send_to_twilio())
     except Exception as e:
         print(f"WebSocket error: {e}")
-            
-
-@app.get("/generate", dependencies=[Depends(verify_api_key)] )
-async def get_latest(client, sid, first: bool = False, timeout: float | None = 30.0, input: str = "", talk_timeout: float | None = 80.0):
-    app.state.time_since_last_talk = time.time()
+    finally:
+        for task in stt_tasks:
+            task.cancel()
+        if session is not None:
+            session.end()
+            if session.turn_marks:
+                # The call ended mid-turn, keep whatever spans completed
+                app.state.metrics.observe_turn(session.finish_turn())
+            app.state.sessions.remove(session.call_sid)
+            if app.state.relay is not None:
+                await app.state.relay.release(session.call_sid)
+            if recorder is not None:
+                recorder.close(session.call_sid, session.summary())
+            print(f"[{session.call_sid}] Turn latencies: {json.dumps(summarize_turns(session.turns))}")
+
+
+def open_session(sid, talk_timeout=80.0, stream_tts=True, stream_stt=True, endpointing=None, barge_in=False):
+    """
+    Returns the session of call `sid` configured for the simulator, creating it
+    if Twilio has not reached us yet. Raises ValueError on bad endpointing settings.
+    """
+    session = app.state.sessions.get_or_create(sid, talk_timeout=talk_timeout, endpointing=app.state.ENDPOINTING)
+    if endpointing:
+        session.endpointing = EndpointConfig.from_dict(endpointing)
+    session.talk_timeout = talk_timeout
+    session.stream_tts = stream_tts
+    session.stream_stt = stream_stt
+    session.barge_in = barge_in
+    session.time_since_last_talk = time.time()
+    return session
+
+
+async def run_turn(sid, first, timeout, input, talk_timeout=80.0, stream_tts=True, stream_stt=True, endpointing=None, barge_in=False):
+    """
+    One simulator turn on a call held by this worker: configures the call
+    (first) or plays `input`, then waits for the agent's next utterance.
+    Returns (utterance, whether the call ended) and raises HTTPException.
+    """
+    if app.state.sessions.ended(sid):
+        # Twilio stopped the stream, usually the agent hanging up after its goodbye
+        return CONVERSATION_ENDED, True
     if first:
         try:
-            reset_app_state()
-            app.state.talk_timeout = talk_timeout
-            app.state.sid = sid
-            await asyncio.wait_for(app.state.transcription_event.wait(), timeout=timeout)
-            app.state.transcription_event = asyncio.Event()
-            response = {"response": app.state.transcription}
-            app.state.active = "user"
-            app.state.first_ = False
-            # app.state.mark_found = False
-            return response
-        except asyncio.TimeoutError:
-            raise HTTPException(status_code=204, detail="No new value")
+            session = open_session(sid, talk_timeout, stream_tts, stream_stt, endpointing, barge_in)
+        except (ValueError, TypeError) as e:
+            raise HTTPException(status_code=400, detail=f"Invalid endpointing settings: {e}")
     else:
-        app.state.input = input
-        app.state.input_event.set()
-        
-        try:
-            await asyncio.wait_for(app.state.transcription_event.wait(), timeout=timeout)
-            app.state.transcription_event = asyncio.Event()
-            response = {"response": app.state.transcription}
-            app.state.active = "user"
-            app.state.mark_found = False
-            return response
-        except asyncio.TimeoutError:
-            raise HTTPException(status_code=204, detail="No new value")
+        session = app.state.sessions.get(sid)
+        if session is None:
+            raise HTTPException(status_code=404, detail=f"Unknown call sid {sid}")
+        session.time_since_last_talk = time.time()
+        if not session.submit_input(input):
+            raise HTTPException(status_code=409, detail=f"Call is {session.state}, not waiting for input")
+    try:
+        response = await asyncio.wait_for(session.transcripts.get(), timeout=timeout)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=204, detail="No new value")
+    return response, session.state == ENDED
+
+
+async def drive_turn(sid, first, timeout, input, **settings):
+    """
+    Runs the turn here, or forwards it to the worker holding the call's
+    media stream when several workers share a session store.
+    """
+    relay = app.state.relay
+    if relay is not None and app.state.sessions.get(sid) is None and not app.state.sessions.ended(sid):
+        if await relay.ended(sid):
+            return CONVERSATION_ENDED, True
+        # Twilio may not have opened the media stream yet on the first turn
+        owner = await relay.find_owner(sid, wait=(timeout or 30.0) if first else 0.0)
+        if owner is None:
+            if await relay.ended(sid):
+                return CONVERSATION_ENDED, True
+            if first:
+                raise HTTPException(status_code=204, detail="No new value")
+            raise HTTPException(status_code=404, detail=f"Unknown call sid {sid}")
+        if owner != relay.worker_id:
+            request = {"sid": sid, "first": first, "timeout": timeout, "input": input, "settings": settings}
+            reply = await relay.forward(owner, request, timeout=(timeout or 30.0) + 5.0)
+            if reply is None:
+                raise HTTPException(status_code=504, detail=f"Worker {owner} did not answer for call {sid}")
+            if reply["status"] != 200:
+                raise HTTPException(status_code=reply["status"], detail=reply.get("detail"))
+            return reply["response"], reply["ended"]
+    return await run_turn(sid, first, timeout, input, **settings)
+
+
+async def serve_forwarded_turn(request):
+    """Runs a turn forwarded by another worker, returning the reply for relay.Relay."""
+    try:
+        response, ended = await run_turn(request["sid"], request["first"], request["timeout"], request["input"], **request["settings"])
+    except HTTPException as e:
+        return {"status": e.status_code, "detail": e.detail}
+    return {"status": 200, "response": response, "ended": ended}
+
+
+@app.get("/generate", dependencies=[Depends(verify_api_key)] )
+async def get_latest(sid, first: bool = False, timeout: float | None = 30.0, input: str = "", talk_timeout: float | None = 80.0, stream_tts: bool = True, stream_stt: bool = True, endpointing: str | None = None, barge_in: bool = False):
+    try:
+        endpointing = json.loads(endpointing) if endpointing and first else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid endpointing settings: {e}")
+    response, _ = await drive_turn(
+        sid, first, timeout, input,
+        talk_timeout=talk_timeout, stream_tts=stream_tts, stream_stt=stream_stt, endpointing=endpointing,
+        barge_in=barge_in,
+    )
+    return {"response": response}
+
+
+@app.post("/tts/prewarm", dependencies=[Depends(verify_api_key)])
+async def prewarm_tts(request: Request):
+    """
+    Synthesizes the simulated user's known lines into the TTS cache before
+    the calls are placed, so they start playing instantly. Expects
+    {"texts": [...]} and returns how many were already cached, synthesized or failed.
+    """
+    try:
+        texts = (await request.json())["texts"]
+        if not all(isinstance(text, str) for text in texts):
+            raise TypeError("texts must be strings")
+    except (ValueError, KeyError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Expected a JSON body with a list of texts: {e!r}")
+    cache = app.state.tts_cache
+    speech = app.state.speech
+    voice = speech.voice_key()
+    if cache is None or voice is None:
+        raise HTTPException(status_code=409, detail="The TTS cache is disabled")
+
+    counts = {"cached": 0, "synthesized": 0, "failed": 0}
+    limit = asyncio.Semaphore(4)  # stay well under the provider's concurrency limit
+
+    async def warm(text):
+        key = cache.key(text, voice)
+        if await cache.contains(key):
+            counts["cached"] += 1
+            return
+        async with limit:
+            pcm = bytearray()
+            try:
+                async for chunk in speech.synthesize(text):
+                    pcm.extend(chunk)
+            except Exception as e:
+                print(f"Error pre-warming TTS for {text!r}: {e!r}")
+                counts["failed"] += 1
+                return
+        await cache.put(key, pcm_to_ulaw(pad_frame(pcm)))
+        counts["synthesized" if pcm else "failed"] += 1
+
+    unique_texts = dict.fromkeys(text.strip() for text in texts if text.strip())
+    await asyncio.gather(*(warm(text) for text in unique_texts))
+    print(f"TTS cache pre-warmed: {counts}")
+    return counts
+
+
+@app.websocket("/turns")
+async def turn_channel(ws: WebSocket):
+    """
+    Persistent turn channel for the simulator, an alternative to polling
+    /generate. The client opens it with a "start" message carrying the call
+    sid and settings, then sends {"type": "input", "text": ...} for every
+    simulated user reply. The server pushes {"type": "transcript", "text": ...}
+    for every agent utterance and {"type": "ended", ...} when the call is over.
+    """
+    api_key = ws.headers.get("x-api-key")
+    if not api_key or api_key != app.state.SECRET_KEY:
+        await ws.close(code=1008, reason="Invalid or missing API Key.")
+        return
+    await ws.accept()
+
+    try:
+        start = await ws.receive_json()
+        if start.get("type") != "start" or not start.get("sid"):
+            await ws.send_json({"type": "error", "detail": "Expected a start message with the call sid"})
+            await ws.close()
+            return
+        settings = {
+            "talk_timeout": float(start.get("talk_timeout", 80.0)),
+            "stream_tts": bool(start.get("stream_tts", True)),
+            "stream_stt": bool(start.get("stream_stt", True)),
+            "endpointing": start.get("endpointing"),
+            "barge_in": bool(start.get("barge_in", False)),
+        }
+        if app.state.relay is not None:
+            await relay_turn_channel(ws, start["sid"], settings)
+            return
+        if app.state.sessions.ended(start["sid"]):
+            await ws.send_json({"type": "ended", "text": CONVERSATION_ENDED})
+            await ws.close()
+            return
+        session = open_session(start["sid"], **settings)
+    except (ValueError, TypeError) as e:
+        await ws.send_json({"type": "error", "detail": f"Invalid start message: {e}"})
+        await ws.close()
+        return
+    except WebSocketDisconnect:
+        return
+    print(f"[{session.call_sid}] Turn channel opened")
+
+    async def push_transcripts():
+        while True:
+            text = await session.transcripts.get()
+            if session.state == ENDED:
+                await ws.send_json({"type": "ended", "text": text})
+                return
+            await ws.send_json({"type": "transcript", "text": text})
+
+    async def read_inputs():
+        async for msg in ws.iter_json():
+            if msg.get("type") != "input":
+                await ws.send_json({"type": "error", "detail": f"Unknown message type {msg.get('type')!r}"})
+                continue
+            session.time_since_last_talk = time.time()
+            if not session.submit_input(msg.get("text", "")):
+                await ws.send_json({"type": "error", "detail": f"Call is {session.state}, not waiting for input"})
+
+    pusher = asyncio.create_task(push_transcripts())
+    reader = asyncio.create_task(read_inputs())
+    try:
+        await asyncio.wait({pusher, reader}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        pusher.cancel()
+        reader.cancel()
+        if pusher.done() and not pusher.cancelled() and pusher.exception() is None:
+            # The conversation ended, let the simulator know by closing the channel
+            try:
+                await ws.close()
+            except RuntimeError:
+                pass
+        print(f"[{session.call_sid}] Turn channel closed")
+
+
+async def relay_turn_channel(ws, sid, settings, timeout=120.0):
+    """
+    /turns when several workers share a session store: each input is a turn
+    run by drive_turn, on this worker or on the one holding the media stream.
+    """
+    print(f"[{sid}] Turn channel opened (relayed)")
+    first, text = True, ""
+    try:
+        while True:
+            try:
+                response, ended = await drive_turn(sid, first, timeout, text, **settings)
+            except HTTPException as e:
+                await ws.send_json({"type": "error", "detail": e.detail})
+                if first:
+                    await ws.close()
+                    return
+            else:
+                await ws.send_json({"type": "ended" if ended else "transcript", "text": response})
+                if ended:
+                    await ws.close()
+                    return
+                first = False
+            msg = await ws.receive_json()
+            while msg.get("type") != "input":
+                await ws.send_json({"type": "error", "detail": f"Unknown message type {msg.get('type')!r}"})
+                msg = await ws.receive_json()
+            text = msg.get("text", "")
+    except WebSocketDisconnect:
+        pass
+    finally:
+        print(f"[{sid}] Turn channel closed")
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics: per-turn latency histograms, counters and load gauges."""
+    lag = app.state.loop_lag
+    gauges = {
+        "active_calls": len(app.state.sessions),
+        "loop_lag_seconds": lag[-1] if lag else 0.0,
+    }
+    if app.state.recorder is not None:
+        gauges["recording_queued_frames"] = app.state.recorder.queued_frames
+        gauges["recording_dropped_frames"] = app.state.recorder.dropped
+    return Response(content=app.state.metrics.render(gauges), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/calls/{sid}", dependencies=[Depends(verify_api_key)])
+async def call_summary(sid):
+    """Turn-by-turn latency breakdown of a live or recently finished call."""
+    session = app.state.sessions.get(sid)
+    if session is not None:
+        return session.summary()
+    if sid in app.state.sessions.finished:
+        return app.state.sessions.finished[sid]
+    raise HTTPException(status_code=404, detail=f"Unknown call sid {sid}")
 
 
 @app.get("/health")
 async def health():
     """Health check endpoint for Docker and load balancers."""
-    return {"status": "healthy", "timestamp": time.time()}
+    lag = app.state.loop_lag
+    return {
+        "status": "healthy",
+        "timestamp": time.time(),
+        "active_calls": len(app.state.sessions),
+        "loop_lag_ms": {
+            "last": round(lag[-1] * 1000, 2) if lag else 0.0,
+            "max_5s": round(max(lag) * 1000, 2) if lag else 0.0,
+        },
+    }
 
 
@@ -0,0 +1,365 @@
+"""
+Offline load generator and latency benchmark for agent_twilio.
+
+Starts the server with the fake speech and Twilio providers (unless --url
+points to a running one) and places synthetic calls against it: a fake
+Twilio media stream replays WAV files (or synthetic speech) as 20 ms u-law
+frames over /media and acknowledges playback marks, while a simulator
+drives the turns through /generate like talk.py does.
+
+    uv run python benchmark.py --ramp 1,4,16,32 --turns 5
+    uv run python benchmark.py --calls 8 --speed 4 --wav agent1.wav agent2.wav
+"""
+import argparse
+import asyncio
+import base64
+import json
+import math
+import os
+import socket
+import struct
+import subprocess
+import sys
+import time
+import uuid
+import wave
+
+import httpx
+from websockets.asyncio.client import connect
+
+from codec import MULAW_FRAME_BYTES, SAMPLE_RATE, pcm_to_ulaw, resample, to_mono, to_pcm16
+
+FRAME_SAMPLES = MULAW_FRAME_BYTES  # 20 ms
+FRAME_SECONDS = FRAME_SAMPLES / SAMPLE_RATE
+API_KEY = "benchmark"
+
+
+def load_wav(path):
+    """Reads a WAV file as 8 kHz mono 16-bit PCM."""
+    with wave.open(path, "rb") as wf:
+        channels, width, rate = wf.getnchannels(), wf.getsampwidth(), wf.getframerate()
+        pcm = wf.readframes(wf.getnframes())
+    if channels not in (1, 2):
+        raise ValueError(f"{path}: unsupported channel count {channels}")
+    pcm = to_mono(to_pcm16(pcm, width), channels)
+    return resample(pcm, rate, SAMPLE_RATE)
+
+
+def synthetic_speech(seconds):
+    """Voiced, amplitude-modulated harmonics that webrtcvad classifies as speech."""
+    samples = []
+    for i in range(int(seconds * SAMPLE_RATE)):
+        t = i / SAMPLE_RATE
+        voice = (3000 * math.sin(2 * math.pi * 150 * t) + 2000 * math.sin(2 * math.pi * 300 * t)
+                 + 1500 * math.sin(2 * math.pi * 450 * t) + 1000 * math.sin(2 * math.pi * 900 * t))
+        samples.append(int(voice * (0.6 + 0.4 * math.sin(2 * math.pi * 4 * t))))
+    return struct.pack(f"<{len(samples)}h", *samples)
+
+
+def to_frames(pcm):
+    """Splits PCM into base64 u-law payloads of one Twilio media frame each."""
+    frame_bytes = FRAME_SAMPLES * 2
+    if len(pcm) % frame_bytes:
+        pcm += bytes(frame_bytes - len(pcm) % frame_bytes)
+    mulaw = pcm_to_ulaw(pcm)
+    return [base64.b64encode(mulaw[i:i + FRAME_SAMPLES]).decode("ascii") for i in range(0, len(mulaw), FRAME_SAMPLES)]
+
+
+SILENCE_FRAME = to_frames(bytes(FRAME_SAMPLES * 2))[0]
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class LoopLag:
+    """Tracks how late this process' own event loop runs, to flag a saturated load generator."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.samples = []
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - start - self.interval))
+
+
+class FakeTwilioStream:
+    """
+    Plays Twilio's side of a media stream: sends inbound audio at 50 frames
+    per second (times `speed`), silence when the agent isn't talking, and
+    echoes playback marks once the audio we were sent would have finished.
+    """
+
+    def __init__(self, url, call_sid, speed):
+        self.url = url
+        self.call_sid = call_sid
+        self.stream_sid = f"MZ{uuid.uuid4().hex}"
+        self.speed = speed
+        self.started = asyncio.Event()
+        self.stopped = asyncio.Event()
+        self.utterance = []
+        self.speech_ended = None
+        self.playback_done = None
+        self.playback_started_at = None
+        self.first_media_at = None
+        self.played_frames = 0
+
+    def say(self, frames):
+        """Queues an utterance; the returned future resolves when its last frame was sent."""
+        self.utterance = list(frames)
+        self.speech_ended = asyncio.get_running_loop().create_future()
+        return self.speech_ended
+
+    def expect_playback(self):
+        """Returns a future resolved when the next reply finished playing."""
+        self.playback_done = asyncio.get_running_loop().create_future()
+        self.first_media_at = None
+        self.played_frames = 0
+        return self.playback_done
+
+    async def run(self):
+        async with connect(self.url, max_size=None) as ws:
+            await ws.send(json.dumps({"event": "connected", "protocol": "Call", "version": "1.0.0"}))
+            await ws.send(json.dumps({"event": "start", "sequenceNumber": "1", "start": {
+                "streamSid": self.stream_sid, "callSid": self.call_sid, "tracks": ["inbound"],
+                "mediaFormat": {"encoding": "audio/x-mulaw", "sampleRate": SAMPLE_RATE, "channels": 1},
+            }, "streamSid": self.stream_sid}))
+            self.started.set()
+            reader = asyncio.create_task(self._read(ws))
+            try:
+                await self._pump(ws)
+                await ws.send(json.dumps({"event": "stop", "streamSid": self.stream_sid, "stop": {"callSid": self.call_sid}}))
+            finally:
+                reader.cancel()
+
+    async def _pump(self, ws):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        frame = 0
+        while not self.stopped.is_set():
+            if self.utterance:
+                payload = self.utterance.pop(0)
+                if not self.utterance and not self.speech_ended.done():
+                    self.speech_ended.set_result(time.perf_counter())
+            else:
+                payload = SILENCE_FRAME
+            await ws.send(
+                f'{{"event":"media","sequenceNumber":"{frame + 2}","media":{{"track":"inbound","chunk":"{frame + 1}",'
+                f'"timestamp":"{frame * 20}","payload":"{payload}"}},"streamSid":"{self.stream_sid}"}}'
+            )
+            frame += 1
+            if self.speed > 0:
+                delay = start + frame * FRAME_SECONDS / self.speed - loop.time()
+                await asyncio.sleep(max(0.0, delay))
+            else:
+                await asyncio.sleep(0)
+
+    async def _read(self, ws):
+        async for raw in ws:
+            msg = json.loads(raw)
+            if msg["event"] == "media":
+                if self.first_media_at is None:
+                    self.first_media_at = time.perf_counter()
+                self.played_frames += len(base64.b64decode(msg["media"]["payload"])) / FRAME_SAMPLES
+            elif msg["event"] == "mark":
+                # Twilio plays the audio in real time from the first frame and then returns the mark
+                started = self.first_media_at or time.perf_counter()
+                duration = self.played_frames * FRAME_SECONDS / (self.speed or math.inf)
+                asyncio.create_task(self._echo_mark(ws, msg["mark"]["name"], started + duration))
+
+    async def _echo_mark(self, ws, name, at):
+        await asyncio.sleep(max(0.0, at - time.perf_counter()))
+        await ws.send(json.dumps({"event": "mark", "streamSid": self.stream_sid, "mark": {"name": name}}))
+        if self.playback_done is not None and not self.playback_done.done():
+            self.playback_done.set_result(time.perf_counter())
+
+
+async def generate(client, call_sid, args, first=False, text=""):
+    params = {"sid": call_sid, "first": first, "timeout": args.turn_timeout, "input": text}
+    if first and args.endpointing:
+        params["endpointing"] = args.endpointing
+    response = await client.get("/generate", params=params, timeout=args.turn_timeout + 10)
+    if response.status_code != 200:
+        raise RuntimeError(f"/generate returned {response.status_code}: {response.text}")
+    return response.json()["response"]
+
+
+async def run_call(index, args, client, ws_url, utterances, stats):
+    """Places one synthetic call and records its per-turn latencies."""
+    call_sid = f"CA{uuid.uuid4().hex}"
+    stream = FakeTwilioStream(ws_url, call_sid, args.speed)
+    stream_task = asyncio.create_task(stream.run())
+    pending = None
+    try:
+        await client.post("/twilio-voice", data={"CallSid": call_sid})
+        pending = asyncio.create_task(generate(client, call_sid, args, first=True))
+        await asyncio.wait_for(stream.started.wait(), timeout=10)
+        for turn in range(args.turns):
+            speech_ended = stream.say(utterances[(index + turn) % len(utterances)])
+            ended_at = await speech_ended
+            await asyncio.wait_for(pending, timeout=args.turn_timeout)
+            stats["turn_latency"].append(time.perf_counter() - ended_at)
+            if turn == args.turns - 1:
+                break
+            playback_done = stream.expect_playback()
+            sent_at = time.perf_counter()
+            pending = asyncio.create_task(generate(client, call_sid, args, text=f"respuesta {turn} de la llamada {index}"))
+            await asyncio.wait_for(playback_done, timeout=args.turn_timeout)
+            stats["first_audio"].append(stream.first_media_at - sent_at)
+        stats["completed"] += 1
+    except Exception as e:
+        stats["errors"].append(f"call {index}: {e!r}")
+    finally:
+        stream.stopped.set()
+        if pending is not None and not pending.done():
+            pending.cancel()
+        try:
+            await asyncio.wait_for(stream_task, timeout=5)
+        except Exception:
+            stream_task.cancel()
+
+
+async def poll_server_lag(client, samples):
+    while True:
+        try:
+            health = (await client.get("/health")).json()
+            samples.append(health["loop_lag_ms"]["max_5s"])
+        except (httpx.HTTPError, KeyError):
+            pass
+        await asyncio.sleep(1.0)
+
+
+async def run_level(calls, args, base_url, utterances):
+    """Runs `calls` simultaneous calls and returns their aggregated statistics."""
+    stats = {"calls": calls, "completed": 0, "errors": [], "turn_latency": [], "first_audio": [], "server_lag_ms": []}
+    ws_url = "ws" + base_url[len("http"):] + "/media"
+    limits = httpx.Limits(max_connections=calls * 2 + 4, max_keepalive_connections=calls * 2 + 4)
+    async with httpx.AsyncClient(base_url=base_url, headers={"x-api-key": args.api_key}, limits=limits) as client:
+        client_lag = LoopLag()
+        monitors = [asyncio.create_task(client_lag.run()), asyncio.create_task(poll_server_lag(client, stats["server_lag_ms"]))]
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(run_call(i, args, client, ws_url, utterances, stats) for i in range(calls)))
+        finally:
+            for task in monitors:
+                task.cancel()
+        stats["wall_time"] = time.perf_counter() - started
+        stats["client_lag_ms"] = max(client_lag.samples, default=0.0) * 1000
+    return stats
+
+
+def summarize(stats):
+    ms = lambda values, p: percentile(values, p) * 1000
+    return {
+        "calls": stats["calls"],
+        "completed": stats["completed"],
+        "errors": len(stats["errors"]),
+        "turns": len(stats["turn_latency"]),
+        "turn_latency_ms": {p: round(ms(stats["turn_latency"], p), 1) for p in (50, 95, 99)},
+        "first_audio_ms": {p: round(ms(stats["first_audio"], p), 1) for p in (50, 95, 99)},
+        "server_loop_lag_ms": {"max": max(stats["server_lag_ms"], default=0.0), "p95": percentile(stats["server_lag_ms"], 95)},
+        "client_loop_lag_ms": round(stats["client_lag_ms"], 1),
+        "wall_time_s": round(stats["wall_time"], 1),
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(args):
+    """Launches agent_twilio with fake providers and waits until it is healthy."""
+    port = free_port()
+    env = dict(os.environ, SPEECH_PROVIDER="fake", TWILIO_PROVIDER="fake", API_KEY=args.api_key,
+               FAKE_STT_LATENCY=str(args.stt_latency), FAKE_TTS_LATENCY=str(args.tts_latency),
+               TTS_CACHE="off")  # measure synthesis, not hits left in ./tts_cache by earlier runs
+    log = open(args.server_log, "w") if args.server_log else subprocess.DEVNULL
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "agent_twilio:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        env=env, stdout=log, stderr=subprocess.STDOUT, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("agent_twilio exited during startup, see --server-log")
+        try:
+            if httpx.get(f"{base_url}/health", timeout=1).status_code == 200:
+                return process, base_url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("agent_twilio did not become healthy in 30 s")
+
+
+async def main(args):
+    if args.wav:
+        utterances = [to_frames(load_wav(path)) for path in args.wav]
+    else:
+        utterances = [to_frames(synthetic_speech(seconds)) for seconds in (1.0, 1.8, 2.6)]
+
+    process = None
+    base_url = args.url
+    if base_url is None:
+        process, base_url = start_server(args)
+    levels = [int(x) for x in args.ramp.split(",")] if args.ramp else [args.calls]
+    results = []
+    try:
+        for calls in levels:
+            summary = summarize(await run_level(calls, args, base_url, utterances))
+            results.append(summary)
+            ok = (summary["errors"] == 0 and summary["turn_latency_ms"][95] <= args.slo_ms
+                  and summary["server_loop_lag_ms"]["max"] <= args.lag_budget_ms)
+            summary["within_slo"] = ok
+            print(f"calls={calls:4d} turns={summary['turns']:5d} errors={summary['errors']:3d} "
+                  f"turn p50/p95/p99={summary['turn_latency_ms'][50]:.0f}/{summary['turn_latency_ms'][95]:.0f}/{summary['turn_latency_ms'][99]:.0f} ms "
+                  f"first audio p50/p95={summary['first_audio_ms'][50]:.0f}/{summary['first_audio_ms'][95]:.0f} ms "
+                  f"server lag max={summary['server_loop_lag_ms']['max']:.1f} ms client lag max={summary['client_loop_lag_ms']:.1f} ms "
+                  f"{'OK' if ok else 'OVER SLO'}", flush=True)
+            if not ok and args.ramp:
+                break
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+
+    passing = [r["calls"] for r in results if r["within_slo"]]
+    print(f"max concurrent calls per worker within SLO (p95 turn <= {args.slo_ms:.0f} ms, "
+          f"loop lag <= {args.lag_budget_ms:.0f} ms): {max(passing) if passing else 0}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="benchmark a running server instead of starting one with fake providers")
+    parser.add_argument("--api-key", default=os.getenv("API_KEY", API_KEY), help="x-api-key for /generate")
+    parser.add_argument("--calls", type=int, default=1, help="simultaneous calls (ignored with --ramp)")
+    parser.add_argument("--ramp", help="comma separated concurrency levels, stops at the first one over SLO")
+    parser.add_argument("--turns", type=int, default=4, help="agent turns per call")
+    parser.add_argument("--speed", type=float, default=1.0, help="audio pacing, 1 = real time, 0 = as fast as possible")
+    parser.add_argument("--wav", nargs="*", help="agent utterances to replay, resampled to 8 kHz mono")
+    parser.add_argument("--endpointing", help="endpointing settings (JSON) sent on the first /generate")
+    parser.add_argument("--stt-latency", type=float, default=0.05, help="fake S2T latency in seconds")
+    parser.add_argument("--tts-latency", type=float, default=0.05, help="fake TTS latency in seconds")
+    parser.add_argument("--turn-timeout", type=float, default=30.0)
+    parser.add_argument("--slo-ms", type=float, default=4000.0, help="p95 turn latency budget, silence wait included")
+    parser.add_argument("--lag-budget-ms", type=float, default=50.0, help="server event loop lag budget")
+    parser.add_argument("--server-log", help="file for the spawned server's output")
+    parser.add_argument("--json", help="write the per-level summaries to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,134 @@
+"""
+Audio and message codec for the Twilio media hot path, without audioop
+(removed in Python 3.13). u-law conversion is a NumPy table lookup that is
+bit-exact with audioop, frames are memoryview slices of the utterance and
+media messages skip the generic JSON encoder/decoder.
+"""
+import binascii
+import json
+import re
+
+import numpy as np
+
+SAMPLE_RATE = 8000
+FRAME_MS = 20  # Twilio media frames are 20 ms long
+MULAW_FRAME_BYTES = 160  # 20 ms of 8 kHz u-law audio, Twilio's media frame size
+PCM_FRAME_BYTES = MULAW_FRAME_BYTES * 2  # the same 20 ms as 16-bit linear PCM
+
+
+def _ulaw_decode_table():
+    ulaw = ~np.arange(256, dtype=np.int32) & 0xFF
+    magnitude = (((ulaw & 0x0F) << 3) + 0x84) << ((ulaw & 0x70) >> 4)
+    return np.where(ulaw & 0x80, 0x84 - magnitude, magnitude - 0x84).astype("<i2")
+
+
+def _ulaw_encode_table():
+    # G.711 on the 14 most significant bits, indexed by the sample's uint16 bit pattern
+    pcm = np.arange(65536, dtype=np.int32)
+    pcm = np.where(pcm >= 32768, pcm - 65536, pcm) >> 2
+    mask = np.where(pcm < 0, 0x7F, 0xFF)
+    magnitude = np.minimum(np.abs(pcm), 8159) + (0x84 >> 2)
+    segment = np.searchsorted(np.array([0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF, 0x1FFF]), magnitude)
+    ulaw = np.where(segment >= 8, 0x7F, (segment << 4) | ((magnitude >> (segment + 1)) & 0x0F))
+    return (ulaw ^ mask).astype(np.uint8)
+
+
+ULAW_TO_PCM = _ulaw_decode_table()
+PCM_TO_ULAW = _ulaw_encode_table()
+
+
+def ulaw_to_pcm(ulaw):
+    """Decodes u-law bytes (any bytes-like object) to 16-bit little-endian PCM."""
+    return ULAW_TO_PCM.take(np.frombuffer(ulaw, dtype=np.uint8)).tobytes()
+
+
+def pcm_to_ulaw(pcm):
+    """Encodes 16-bit little-endian PCM (any bytes-like object) to u-law bytes."""
+    return PCM_TO_ULAW.take(np.frombuffer(pcm, dtype="<u2")).tobytes()
+
+
+def rms(pcm):
+    """Root mean square of 16-bit PCM, truncated like audioop.rms."""
+    samples = np.frombuffer(pcm, dtype="<i2")
+    if not samples.size:
+        return 0
+    return int(np.sqrt(np.mean(np.square(samples, dtype=np.float64))))
+
+
+def pad_frame(pcm):
+    """Pads 16-bit PCM with silence up to a whole number of 20 ms frames."""
+    remainder = len(pcm) % PCM_FRAME_BYTES
+    if remainder:
+        return bytes(pcm) + bytes(PCM_FRAME_BYTES - remainder)
+    return bytes(pcm)
+
+
+def frames(audio, size=MULAW_FRAME_BYTES):
+    """Zero-copy split of `audio` into `size`-byte memoryview slices (the last one may be shorter)."""
+    view = memoryview(audio)
+    return [view[offset:offset + size] for offset in range(0, len(view), size)]
+
+
+def media_message(stream_sid, ulaw):
+    """Twilio media message carrying `ulaw`, serialized by hand (base64 never needs escaping)."""
+    payload = binascii.b2a_base64(ulaw, newline=False).decode("ascii")
+    return f'{{"event":"media","streamSid":{json.dumps(stream_sid)},"media":{{"payload":"{payload}"}}}}'
+
+
+# Fields of the inbound media envelope, matched without decoding the whole message
+_MEDIA_EVENT = re.compile(r'"event"\s*:\s*"media"')
+_PAYLOAD = re.compile(r'"payload"\s*:\s*"([A-Za-z0-9+/=]*)"')
+_TIMESTAMP = re.compile(r'"timestamp"\s*:\s*"?(\d+)')
+
+
+def parse_message(raw):
+    """
+    Parses a Twilio media stream message. Media messages (50 per second per
+    call) take a fast path that only extracts the payload and timestamp;
+    anything else, or anything unexpected, goes through json.loads.
+    """
+    if _MEDIA_EVENT.search(raw):
+        payload = _PAYLOAD.search(raw)
+        timestamp = _TIMESTAMP.search(raw)
+        if payload is not None and timestamp is not None:
+            return {"event": "media", "media": {"payload": payload.group(1), "timestamp": timestamp.group(1)}}
+    return json.loads(raw)
+
+
+def decode_payload(payload):
+    """Decodes a base64 media payload straight to 16-bit PCM."""
+    return ulaw_to_pcm(binascii.a2b_base64(payload))
+
+
+def to_pcm16(pcm, width):
+    """Converts signed little-endian PCM (unsigned for 8-bit, as in WAV) to 16-bit."""
+    if width == 2:
+        return bytes(pcm)
+    if width == 1:
+        samples = (np.frombuffer(pcm, dtype=np.uint8).astype(np.int16) - 128) << 8
+    elif width == 3:
+        raw = np.frombuffer(pcm, dtype=np.uint8).reshape(-1, 3)
+        samples = raw[:, 1].astype(np.int16) | (raw[:, 2].astype(np.int8).astype(np.int16) << 8)
+    elif width == 4:
+        samples = (np.frombuffer(pcm, dtype="<i4") >> 16).astype(np.int16)
+    else:
+        raise ValueError(f"Unsupported sample width {width}")
+    return samples.astype("<i2").tobytes()
+
+
+def to_mono(pcm, channels):
+    """Averages interleaved 16-bit channels into one."""
+    if channels == 1:
+        return bytes(pcm)
+    samples = np.frombuffer(pcm, dtype="<i2").reshape(-1, channels)
+    return np.floor(samples.mean(axis=1)).astype("<i2").tobytes()
+
+
+def resample(pcm, rate, target_rate=SAMPLE_RATE):
+    """Linear-interpolation resampling of 16-bit mono PCM."""
+    if rate == target_rate:
+        return bytes(pcm)
+    samples = np.frombuffer(pcm, dtype="<i2").astype(np.float64)
+    count = int(len(samples) * target_rate / rate)
+    positions = np.arange(count) * (rate / target_rate)
+    return np.interp(positions, np.arange(len(samples)), samples).round().astype("<i2").tobytes()
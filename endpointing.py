@@ -0,0 +1,202 @@
+import math
+from collections import deque
+
+from codec import FRAME_MS, rms
+
+# Events returned by Endpointer.process
+SPEECH_START = "speech_start"  # first speech frame of a new utterance
+SPEECH = "speech"  # speech resumed after a pause
+SILENCE = "silence"  # a pause started inside the utterance
+ENDPOINT = "endpoint"  # the utterance is over, send it to S2T
+DISCARD = "discard"  # the "utterance" was too short to be speech, drop it
+
+STRATEGIES = ("fixed", "adaptive")
+
+
+def _number(name, value, kind=float, minimum=0):
+    """
+    Validates a numeric setting, which may come as a string from JSON or
+    YAML. Raises ValueError so bad settings are rejected when a call is
+    configured instead of failing in the middle of it.
+    """
+    if isinstance(value, bool):
+        raise ValueError(f"{name} must be a number, got {value!r}")
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be a number, got {value!r}") from None
+    if not math.isfinite(number) or (minimum is not None and number < minimum):
+        raise ValueError(f"{name} must be a finite number of at least {minimum}, got {value!r}")
+    return kind(number)
+
+
+class EndpointConfig:
+    """
+    End-of-turn detection settings. By default a turn ends after a fixed
+    2.8 s of silence following any speech frame, as it historically did.
+    """
+
+    def __init__(self, strategy="fixed", silence_ms=2800, min_silence_ms=800, min_speech_ms=0,
+                 hangover_ms=0, energy_gate_db=None, long_utterance_ms=4000, long_utterance_factor=0.6,
+                 falling_energy_ratio=0.5, falling_energy_factor=0.6, pre_roll_ms=200, max_utterance_ms=30000,
+                 barge_in_ms=300, speculative_ms=0):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown endpointing strategy {strategy!r}, expected one of {STRATEGIES}")
+        self.strategy = strategy
+        self.silence_ms = _number("silence_ms", silence_ms, int)  # silence that ends a turn
+        # lower bound for the adaptive strategy
+        self.min_silence_ms = _number("min_silence_ms", min_silence_ms, int)
+        # shorter utterances are treated as noise
+        self.min_speech_ms = _number("min_speech_ms", min_speech_ms, int)
+        # VAD drop-outs shorter than this still count as speech
+        self.hangover_ms = _number("hangover_ms", hangover_ms, int)
+        # frames quieter than this (dBFS) are never speech
+        self.energy_gate_db = None if energy_gate_db is None else _number("energy_gate_db", energy_gate_db, minimum=None)
+        self.long_utterance_ms = _number("long_utterance_ms", long_utterance_ms, int)
+        # shortens the wait after long monologues
+        self.long_utterance_factor = _number("long_utterance_factor", long_utterance_factor)
+        self.falling_energy_ratio = _number("falling_energy_ratio", falling_energy_ratio)
+        # shortens the wait after a sentence-final fade out
+        self.falling_energy_factor = _number("falling_energy_factor", falling_energy_factor)
+        # audio kept from before the first speech frame, so word onsets aren't clipped
+        self.pre_roll_ms = _number("pre_roll_ms", pre_roll_ms, int)
+        # longer utterances are flushed to S2T (e.g. an IVR that never pauses)
+        self.max_utterance_ms = _number("max_utterance_ms", max_utterance_ms, int, minimum=1)
+        # speech during our playback that counts as an interruption
+        self.barge_in_ms = _number("barge_in_ms", barge_in_ms, int)
+        # pause after which S2T starts before the endpoint, 0 disables
+        self.speculative_ms = _number("speculative_ms", speculative_ms, int)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Builds a config from a (possibly partial) dict, e.g. from config.yaml."""
+        data = dict(data or {})
+        unknown = set(data) - set(cls().__dict__)
+        if unknown:
+            raise ValueError(f"Unknown endpointing settings: {', '.join(sorted(unknown))}")
+        return cls(**data)
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    def buffer_bytes(self, frame_bytes, frame_ms=FRAME_MS):
+        """Capacity of a call's utterance buffer: the pre-roll plus the longest utterance."""
+        return (self.pre_roll_ms + self.max_utterance_ms) // frame_ms * frame_bytes
+
+    def pre_roll_bytes(self, frame_bytes, frame_ms=FRAME_MS):
+        return self.pre_roll_ms // frame_ms * frame_bytes
+
+    def speculate_frames(self, frame_ms=FRAME_MS):
+        """Silent frames before speculative S2T, 0 when disabled."""
+        return int(self.speculative_ms // frame_ms)
+
+
+def frame_db(pcm):
+    """Loudness of a 16-bit PCM frame in dBFS."""
+    level = rms(pcm)
+    if level == 0:
+        return -math.inf
+    return 20 * math.log10(level / 32768)
+
+
+class Endpointer:
+    """
+    Turns per-frame VAD decisions into utterance events for one call.
+    After each call to process(), `speech` tells whether the frame should be
+    considered speech once the energy gate and the hangover are applied, and
+    `forced` whether an ENDPOINT was caused by the maximum utterance length.
+    """
+
+    def __init__(self, config=None, frame_ms=FRAME_MS):
+        self.config = config or EndpointConfig()
+        self.frame_ms = frame_ms
+        self.recent_energy = deque(maxlen=max(1, 300 // frame_ms))
+        self.forced = False
+        self.reset()
+
+    def reset(self):
+        self.in_utterance = False
+        self.speech = False
+        self.speech_frames = 0
+        self.silence_frames = 0
+        self.utterance_frames = 0  # every frame since the utterance started, speech or not
+        self.hangover_frames = 0
+        self.energy_sum = 0.0
+        self.recent_energy.clear()
+        self.silence_trigger = None
+
+    def _frames(self, ms):
+        return max(1, int(ms // self.frame_ms))
+
+    def speech_ms(self):
+        """Speech heard so far in the current utterance."""
+        return self.speech_frames * self.frame_ms
+
+    def silence_threshold_ms(self):
+        """Silence needed to end the current utterance."""
+        config = self.config
+        threshold = config.silence_ms
+        if config.strategy == "adaptive" and self.speech_frames:
+            if self.speech_frames * self.frame_ms >= config.long_utterance_ms:
+                threshold *= config.long_utterance_factor
+            mean_energy = self.energy_sum / self.speech_frames
+            tail_energy = sum(self.recent_energy) / len(self.recent_energy)
+            if tail_energy < mean_energy * config.falling_energy_ratio:
+                threshold *= config.falling_energy_factor
+            threshold = max(config.min_silence_ms, threshold)
+        return threshold
+
+    def process(self, pcm, vad_speech):
+        """Feeds one frame and returns one of the module's events, or None."""
+        self.forced = False
+        event = self._process(pcm, vad_speech)
+        if self.in_utterance:
+            self.utterance_frames += 1
+            if self.utterance_frames >= self._frames(self.config.max_utterance_ms):
+                speech = self.speech
+                self.reset()
+                self.speech = speech
+                self.forced = True
+                return ENDPOINT
+        return event
+
+    def _process(self, pcm, vad_speech):
+        config = self.config
+        is_speech = vad_speech
+        if is_speech and config.energy_gate_db is not None and frame_db(pcm) < config.energy_gate_db:
+            is_speech = False
+
+        if is_speech:
+            self.hangover_frames = self._frames(config.hangover_ms) if config.hangover_ms else 0
+            level = rms(pcm)
+            self.energy_sum += level
+            self.recent_energy.append(level)
+            self.speech_frames += 1
+            self.speech = True
+            resumed = self.silence_frames > 0
+            self.silence_frames = 0
+            self.silence_trigger = None
+            if not self.in_utterance:
+                self.in_utterance = True
+                return SPEECH_START
+            return SPEECH if resumed else None
+
+        if not self.in_utterance:
+            self.speech = False
+            return None
+
+        if self.hangover_frames:
+            self.hangover_frames -= 1
+            self.speech = True
+            return None
+
+        self.speech = False
+        self.silence_frames += 1
+        if self.silence_trigger is None:
+            # Speech statistics don't change during a pause, compute the threshold once
+            self.silence_trigger = self._frames(self.silence_threshold_ms())
+        if self.silence_frames >= self.silence_trigger:
+            too_short = self.speech_frames * self.frame_ms < config.min_speech_ms
+            self.reset()
+            return DISCARD if too_short else ENDPOINT
+        return SILENCE if self.silence_frames == 1 else None
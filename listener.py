@@ -0,0 +1,96 @@
+import webrtcvad
+
+from codec import PCM_FRAME_BYTES, SAMPLE_RATE
+from endpointing import SPEECH_START, Endpointer
+from ringbuffer import reserve
+
+
+class Listener:
+    """
+    What happens to each 20 ms frame of the remote agent's audio while we
+    listen: VAD, end-of-turn detection, the pre-roll kept before speech
+    starts and the transcription stream of the utterance being spoken.
+    Shared by media_stream and replay.py so offline replays go through
+    exactly the live pipeline.
+    """
+
+    def __init__(self, speech, config, vad_mode=3, sample_rate=SAMPLE_RATE):
+        self.speech = speech
+        self.sample_rate = sample_rate
+        self.vad = webrtcvad.Vad()
+        self.vad.set_mode(vad_mode)  # 3 is most aggressive
+        self.endpointer = Endpointer(config)
+        self.utterance = None  # transcription stream of the utterance being spoken
+        self.utterance_buffer = None  # pre-allocated audio of the current utterance, reused all call long
+        self.preroll = None  # the last few frames before the agent starts speaking
+        self.lead_in = None  # the same pre-roll for the segments after the first one
+        self.pending_config = None  # applied once the utterance in progress is over
+
+    @property
+    def config(self):
+        return self.pending_config or self.endpointer.config
+
+    @config.setter
+    def config(self, config):
+        # The utterance buffer was sized for the current config, swap it between utterances only
+        if self.utterance is None:
+            self.endpointer.config = config
+            self.pending_config = None
+        else:
+            self.pending_config = config
+
+    def process(self, pcm, incremental=True):
+        """
+        Runs one frame of 16-bit PCM through VAD and the endpointer and
+        returns the endpointing event (None when VAD fails). A transcription
+        stream is opened on SPEECH_START and fed every frame after it, the
+        trailing silence included.
+        """
+        try:
+            is_speech = self.vad.is_speech(pcm, sample_rate=self.sample_rate)
+        except Exception as e:
+            print(f"Error processing VAD: {e}")
+            return None
+        if self.pending_config is not None and self.utterance is None:
+            self.config = self.pending_config
+        event = self.endpointer.process(pcm, is_speech)
+        if event == SPEECH_START:
+            self.utterance_buffer = reserve(self.utterance_buffer, self.config.buffer_bytes(PCM_FRAME_BYTES))
+            preroll_bytes = self.config.pre_roll_bytes(PCM_FRAME_BYTES)
+            self.lead_in = reserve(self.lead_in, preroll_bytes) if preroll_bytes else None
+            self.utterance = self.speech.open_stream(
+                self.utterance_buffer,
+                incremental=incremental,
+                preroll=self.preroll.getvalue() if self.preroll is not None else b"",
+                speculate_frames=self.config.speculate_frames(),
+                lead_in=self.lead_in,
+            )
+        if self.utterance is None:
+            # Keep the audio just before the agent speaks so word onsets aren't clipped
+            preroll_bytes = self.config.pre_roll_bytes(PCM_FRAME_BYTES)
+            self.preroll = reserve(self.preroll, preroll_bytes) if preroll_bytes else None
+            if self.preroll is not None:
+                self.preroll.extend(pcm)
+        else:
+            self.utterance.feed(pcm, self.endpointer.speech)
+        return event
+
+    def take(self):
+        """Hands the finished utterance's transcription stream over to the caller."""
+        utterance, self.utterance = self.utterance, None
+        if self.preroll is not None:
+            self.preroll.clear()
+        return utterance
+
+    def cancel(self):
+        """Drops the utterance being spoken."""
+        if self.utterance is not None:
+            self.utterance.cancel()
+            self.utterance = None
+
+    def reset(self):
+        """Forgets everything heard so far, e.g. while the agent's audio is ignored."""
+        self.cancel()
+        self.endpointer.reset()
+        if self.preroll is not None:
+            self.preroll.clear()
@@ -0,0 +1,115 @@
+import math
+
+# Latency buckets in seconds, from a single frame up to a slow S2T round trip
+BUCKETS = (0.02, 0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 8.0, 13.0, 20.0, 30.0)
+
+# Per-turn spans: name -> (start mark, end mark, help). A turn starts when the
+# remote agent starts talking and ends when Twilio confirms our reply played.
+SPANS = {
+    "agent_speech": ("speech_start", "speech_end", "Duration of the remote agent's utterance"),
+    "silence_wait": ("speech_end", "endpoint", "Silence waited before declaring the end of the agent's turn"),
+    "stt": ("endpoint", "stt_response", "S2T time left after the end of the agent's turn"),
+    "agent_turn": ("speech_end", "stt_response", "From the end of the agent's speech to its transcript"),
+    "input_wait": ("stt_response", "input_received", "Time the simulator took to answer through /generate"),
+    "tts_first_byte": ("input_received", "tts_first_byte", "From the user's reply to the first TTS audio chunk"),
+    "first_frame": ("input_received", "first_frame_sent", "From the user's reply to the first media frame sent to Twilio"),
+    "playback": ("first_frame_sent", "playback_mark", "From the first media frame to Twilio's endOfPlayback mark"),
+    "barge_in": ("first_frame_sent", "barge_in", "Playback time before the agent interrupted our reply"),
+    "turn": ("speech_start", "playback_mark", "Whole turn, from the agent speaking to our reply finishing"),
+}
+
+
+def turn_spans(marks):
+    """Durations (seconds) of the spans whose start and end were both marked."""
+    spans = {}
+    for name, (start, end, _) in SPANS.items():
+        if start in marks and end in marks:
+            spans[name] = max(0.0, marks[end] - marks[start])
+    return spans
+
+
+class Histogram:
+    """Cumulative histogram rendered in the Prometheus text format."""
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+
+class Metrics:
+    """Process-wide latency histograms and counters exposed on /metrics."""
+
+    def __init__(self, prefix="calling_agent"):
+        self.prefix = prefix
+        self.spans = {
+            name: Histogram(f"{prefix}_{name}_seconds", help) for name, (_, _, help) in SPANS.items()
+        }
+        self.counters = {
+            "calls_total": 0,
+            "turns_total": 0,
+            "stt_errors_total": 0,
+            "stt_speculations_total": 0,
+            "stt_speculative_commits_total": 0,
+            "tts_errors_total": 0,
+            "barge_ins_total": 0,
+            "tts_cache_hits_total": 0,
+            "tts_cache_misses_total": 0,
+        }
+
+    def observe_turn(self, spans):
+        self.counters["turns_total"] += 1
+        for name, value in spans.items():
+            self.spans[name].observe(value)
+
+    def inc(self, counter, value=1):
+        self.counters[counter] += value
+
+    def render(self, gauges=None):
+        """Prometheus exposition of every metric plus the given point-in-time gauges."""
+        lines = []
+        for name, value in self.counters.items():
+            lines += [f"# TYPE {self.prefix}_{name} counter", f"{self.prefix}_{name} {value}"]
+        for name, value in (gauges or {}).items():
+            if value is None or (isinstance(value, float) and math.isnan(value)):
+                continue
+            lines += [f"# TYPE {self.prefix}_{name} gauge", f"{self.prefix}_{name} {value}"]
+        for histogram in self.spans.values():
+            lines += histogram.render()
+        return "\n".join(lines) + "\n"
+
+
+def summarize_turns(turns):
+    """Per-call summary: count, mean and max of every span over the call's turns."""
+    summary = {}
+    for name in SPANS:
+        values = [turn["spans"][name] for turn in turns if name in turn["spans"]]
+        if values:
+            summary[name] = {
+                "count": len(values),
+                "mean": round(sum(values) / len(values), 3),
+                "max": round(max(values), 3),
+            }
+    return summary
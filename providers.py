@@ -0,0 +1,413 @@
+import asyncio
+import functools
+import io
+import math
+import os
+import struct
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from elevenlabs import VoiceSettings
+from elevenlabs.client import AsyncElevenLabs
+from requests.adapters import HTTPAdapter
+from twilio.http.http_client import TwilioHttpClient
+from twilio.rest import Client
+
+from codec import SAMPLE_RATE
+
+
+def pcm_to_wav(pcm, sample_rate=SAMPLE_RATE):
+    """Wraps mono 16-bit PCM in a WAV container for the S2T API."""
+    with io.BytesIO() as wav_buffer:
+        with wave.open(wav_buffer, 'wb') as wf:
+            wf.setnchannels(1)
+            wf.setsampwidth(2)
+            wf.setframerate(sample_rate)
+            wf.writeframes(pcm)
+        return wav_buffer.getvalue()
+
+
+def make_http_client():
+    """
+    Pooled async HTTP client shared by every call of the process, so S2T and
+    T2S requests reuse warm keep-alive connections instead of paying a TCP and
+    TLS handshake per turn. Pool limits come from HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_KEEPALIVE and HTTP_KEEPALIVE_EXPIRY (seconds).
+    """
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", 100)),
+            max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE", 20)),
+            keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 60)),
+        ),
+        timeout=30.0,
+        follow_redirects=True,
+    )
+
+
+class TranscriptionStream:
+    """
+    Base of the objects fed an utterance's audio. With `speculate_frames`,
+    once the speaker has paused that long the audio not yet sent to S2T is
+    transcribed speculatively while we keep listening: the request is
+    cancelled if speech resumes and its result committed if the pause turns
+    out to be the end of the turn (or of the segment), so most of the S2T
+    round trip overlaps with the silence wait.
+    """
+
+    def __init__(self, speech, sample_rate=SAMPLE_RATE, speculate_frames=0):
+        self.speech = speech
+        self.sample_rate = sample_rate
+        self.speculate_frames = speculate_frames
+        self.speculative = None  # S2T task of the pending audio, started at the last pause
+        self.speculations = 0  # speculative requests started
+        self.committed = 0  # speculative results used
+
+    def _speculate(self, pcm):
+        self.speculative = asyncio.ensure_future(self.speech.transcribe(pcm_to_wav(pcm, self.sample_rate)))
+        self.speculations += 1
+
+    def _discard_speculation(self):
+        """Speech resumed, the speculative transcript is incomplete."""
+        if self.speculative is not None:
+            self.speculative.cancel()
+            self.speculative = None
+
+    def _take_speculation(self):
+        """The speculative task, if any, now that nothing but silence followed it."""
+        task, self.speculative = self.speculative, None
+        if task is not None:
+            self.committed += 1
+        return task
+
+    def cancel(self):
+        self._discard_speculation()
+
+
+class BufferedTranscription(TranscriptionStream):
+    """Collects the whole utterance and transcribes it once it has ended."""
+
+    def __init__(self, speech, buffer, preroll=b"", sample_rate=SAMPLE_RATE, speculate_frames=0):
+        super().__init__(speech, sample_rate, speculate_frames)
+        self.audio = buffer  # the call's utterance RingBuffer, reused across utterances
+        self.audio.clear()
+        self.audio.extend(preroll)
+        self.silence_frames = 0
+
+    def feed(self, pcm, is_speech):
+        self.audio.extend(pcm)
+        if is_speech:
+            self.silence_frames = 0
+            self._discard_speculation()
+        else:
+            self.silence_frames += 1
+            if self.silence_frames == self.speculate_frames:
+                self._speculate(self.audio.getvalue())
+
+    def finish(self):
+        """
+        Seals the utterance and returns a task resolving to its transcript.
+        The audio is copied out first, so the buffer is free for the next utterance.
+        """
+        speculative = self._take_speculation()
+        if speculative is not None:
+            self.audio.clear()
+            return speculative
+        wav = pcm_to_wav(self.audio.getvalue(), self.sample_rate) if len(self.audio) else None
+        self.audio.clear()
+        return asyncio.ensure_future(self._transcribe(wav))
+
+    async def _transcribe(self, wav):
+        if wav is None:
+            return ""
+        return await self.speech.transcribe(wav)
+
+
+class SegmentedTranscription(TranscriptionStream):
+    """
+    Incremental S2T on top of a batch provider. The utterance is cut at short
+    pauses and each finished segment is transcribed in the background while
+    the speaker keeps talking, so by the time the end of the turn is detected
+    usually every segment has already been transcribed.
+    """
+
+    def __init__(self, speech, buffer, preroll=b"", sample_rate=SAMPLE_RATE, pause_frames=15, min_segment_frames=25,
+                 speculate_frames=0, lead_in=None):
+        super().__init__(speech, sample_rate, speculate_frames)
+        self.pause_frames = pause_frames  # 300 ms pause closes a segment
+        self.min_segment_frames = min_segment_frames  # don't send fragments shorter than 500 ms of speech
+        self.segment = buffer  # the call's utterance RingBuffer, holds the current segment
+        self.segment.clear()
+        self.segment.extend(preroll)
+        # Pre-roll sized RingBuffer with the audio since the last segment closed, so the next one doesn't clip its onset
+        self.lead_in = lead_in
+        if self.lead_in is not None:
+            self.lead_in.clear()
+        self.segment_speech_frames = 0
+        self.silence_frames = 0
+        self.tasks = []
+
+    def feed(self, pcm, is_speech):
+        if is_speech:
+            if not self.segment_speech_frames and self.lead_in is not None and len(self.lead_in):
+                self.segment.extend(self.lead_in.getvalue())
+                self.lead_in.clear()
+            self.segment.extend(pcm)
+            self.segment_speech_frames += 1
+            self.silence_frames = 0
+            self._discard_speculation()
+        elif self.segment_speech_frames:
+            self.segment.extend(pcm)
+            self.silence_frames += 1
+            if self.silence_frames == self.speculate_frames:
+                # Mostly helps short replies, which never reach min_segment_frames
+                self._speculate(self.segment.getvalue())
+            if self.silence_frames >= self.pause_frames and self.segment_speech_frames >= self.min_segment_frames:
+                self._close_segment()
+        elif self.lead_in is not None:
+            self.lead_in.extend(pcm)
+
+    def _close_segment(self):
+        task = self._take_speculation()
+        if task is None:
+            wav = pcm_to_wav(self.segment.getvalue(), self.sample_rate)
+            task = asyncio.create_task(self.speech.transcribe(wav))
+        self.tasks.append(task)
+        self.segment.clear()
+        self.segment_speech_frames = 0
+        self.silence_frames = 0
+
+    def finish(self):
+        """Closes the remaining audio and returns a task joining all segments in order."""
+        if self.segment_speech_frames:
+            self._close_segment()
+        self.segment.clear()
+        return asyncio.ensure_future(self._join(list(self.tasks)))
+
+    async def _join(self, tasks):
+        texts = await asyncio.gather(*tasks)
+        return " ".join(text.strip() for text in texts if text and text.strip())
+
+    def cancel(self):
+        super().cancel()
+        for task in self.tasks:
+            task.cancel()
+
+
+class SpeechProvider:
+    """Base class for S2T/T2S backends used by the media stream."""
+
+    async def transcribe(self, wav_bytes):
+        raise NotImplementedError
+
+    async def synthesize(self, text):
+        raise NotImplementedError
+        yield
+
+    async def warm_up(self):
+        """Opens connections ahead of the first call. Nothing to do by default."""
+
+    def voice_key(self):
+        """
+        Everything besides the text that determines the synthesized audio,
+        used to key the TTS cache. None disables caching for the provider.
+        """
+        return None
+
+    def open_stream(self, buffer, incremental=True, preroll=b"", speculate_frames=0, lead_in=None):
+        """
+        Returns an object that is fed audio while the remote party speaks,
+        storing it in `buffer` (a RingBuffer) after the `preroll` audio. With
+        `speculate_frames`, S2T starts after that many frames of silence.
+        `lead_in`, a RingBuffer as long as the pre-roll, gives each later
+        segment of an incremental stream the same pre-roll.
+        """
+        if incremental:
+            return SegmentedTranscription(self, buffer, preroll, speculate_frames=speculate_frames, lead_in=lead_in)
+        return BufferedTranscription(self, buffer, preroll, speculate_frames=speculate_frames)
+
+
+class ElevenLabsSpeech(SpeechProvider):
+    """
+    Async speech-to-text and text-to-speech through ElevenLabs, so the media
+    loop keeps reading Twilio frames while a request is in flight.
+    """
+
+    def __init__(self, api_key, voice_id="5IDdqnXnlsZ1FCxoOFYg", tts_model_id="eleven_flash_v2_5",
+                 stt_model_id="scribe_v1", language_code="es", timeout=30.0, http_client=None, warm_connections=2):
+        self.http_client = http_client or make_http_client()
+        self.client = AsyncElevenLabs(api_key=api_key, timeout=timeout, httpx_client=self.http_client)
+        self.warm_connections = warm_connections  # one for S2T and one for T2S by default
+        self.voice_id = voice_id
+        self.tts_model_id = tts_model_id
+        self.stt_model_id = stt_model_id
+        self.language_code = language_code
+        self.timeout = timeout
+        self.voice_settings = VoiceSettings(
+            stability=0.0, similarity_boost=1.0, style=1.0, use_speaker_boost=True, speed=1.0,
+        )
+
+    async def transcribe(self, wav_bytes):
+        """Returns the transcription of a WAV file, raising on timeout."""
+        transcription = await asyncio.wait_for(
+            self.client.speech_to_text.convert(
+                file=wav_bytes,
+                model_id=self.stt_model_id,
+                language_code=self.language_code,
+            ),
+            timeout=self.timeout,
+        )
+        return transcription.text
+
+    async def warm_up(self):
+        """
+        Completes the TCP and TLS handshakes with ElevenLabs so the first turn
+        of the first call doesn't pay for them. Any HTTP response will do.
+        """
+        base_url = self.client._client_wrapper.get_base_url()
+        results = await asyncio.gather(
+            *(self.http_client.head(base_url) for _ in range(self.warm_connections)), return_exceptions=True,
+        )
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            print(f"Could not pre-warm ElevenLabs connections: {errors[0]!r}")
+        else:
+            print(f"Pre-warmed {len(results)} ElevenLabs connections")
+
+    def voice_key(self):
+        return {
+            "provider": "elevenlabs",
+            "voice_id": self.voice_id,
+            "model_id": self.tts_model_id,
+            "language_code": self.language_code,
+            "voice_settings": self.voice_settings.dict(),
+        }
+
+    async def synthesize(self, text):
+        """Yields 8 kHz 16-bit PCM chunks as ElevenLabs produces them."""
+        stream = self.client.text_to_speech.convert(
+            voice_id=self.voice_id, output_format="pcm_8000", text=text, model_id=self.tts_model_id,
+            language_code=self.language_code, voice_settings=self.voice_settings,
+        )
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(stream.__anext__(), timeout=self.timeout)
+                except StopAsyncIteration:
+                    break
+                if chunk:
+                    yield chunk
+        finally:
+            await stream.aclose()
+
+
+class FakeSpeech(SpeechProvider):
+    """
+    Deterministic local stand-in for ElevenLabs. Transcripts describe the
+    audio they were given and synthesized speech is a tone whose length
+    depends on the text, after a configurable latency.
+    """
+
+    def __init__(self, transcript="hola", stt_latency=0.05, tts_latency=0.05, ms_per_char=60, chunk_ms=100):
+        self.transcript = transcript
+        self.stt_latency = stt_latency
+        self.tts_latency = tts_latency
+        self.ms_per_char = ms_per_char
+        self.chunk_bytes = SAMPLE_RATE * 2 * chunk_ms // 1000
+        period = [int(8000 * math.sin(2 * math.pi * 440 * i / SAMPLE_RATE)) for i in range(SAMPLE_RATE)]
+        self.tone = struct.pack(f"<{len(period)}h", *period)  # one second of 440 Hz
+
+    async def transcribe(self, wav_bytes):
+        await asyncio.sleep(self.stt_latency)
+        with wave.open(io.BytesIO(wav_bytes)) as wf:
+            seconds = wf.getnframes() / wf.getframerate()
+        return f"{self.transcript} ({seconds:.2f}s)"
+
+    def voice_key(self):
+        return {"provider": "fake", "ms_per_char": self.ms_per_char}
+
+    async def synthesize(self, text):
+        await asyncio.sleep(self.tts_latency)
+        remaining = max(200, len(text) * self.ms_per_char) * SAMPLE_RATE * 2 // 1000
+        while remaining > 0:
+            size = min(self.chunk_bytes, remaining)
+            yield self.tone[:size]
+            remaining -= size
+            await asyncio.sleep(0)
+
+
+def make_speech_provider(name=None, http_client=None):
+    """
+    Builds the speech provider selected by SPEECH_PROVIDER (elevenlabs or fake).
+    Providers are stateless, one instance (and `http_client`) serves every call.
+    """
+    name = name or os.getenv("SPEECH_PROVIDER", "elevenlabs")
+    if name == "elevenlabs":
+        return ElevenLabsSpeech(api_key=os.getenv("ELEVENLABS_API_KEY_GAL"), http_client=http_client)
+    if name == "fake":
+        return FakeSpeech(
+            stt_latency=float(os.getenv("FAKE_STT_LATENCY", 0.05)),
+            tts_latency=float(os.getenv("FAKE_TTS_LATENCY", 0.05)),
+        )
+    raise ValueError(f"Unknown speech provider {name!r}")
+
+
+class TwilioCalls:
+    """
+    Runs the blocking Twilio REST client on a small bounded thread pool so
+    hang-ups never stall the event loop.
+    """
+
+    def __init__(self, client, max_workers=4, timeout=10.0):
+        self.client = client
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="twilio-rest")
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(
+            loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs)),
+            timeout=self.timeout,
+        )
+
+    async def hangup(self, call_sid):
+        """Marks the call as completed on Twilio's side."""
+        try:
+            await self._run(self.client.calls(f"{call_sid}").update, status='completed')
+        except Exception as e:
+            print(f"[{call_sid}] Error hanging up call: {e}")
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class FakeTwilioCalls:
+    """Stand-in for TwilioCalls when no real calls are placed (benchmarks, tests)."""
+
+    async def hangup(self, call_sid):
+        print(f"[{call_sid}] Fake hang up")
+
+    def close(self):
+        pass
+
+
+def make_twilio_client(pool_size=10):
+    """
+    Twilio REST client backed by one keep-alive requests session, sized for
+    `pool_size` threads using it at the same time. Build it once and share it.
+    """
+    http_client = TwilioHttpClient(pool_connections=True)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    http_client.session.mount("https://", adapter)
+    return Client(os.environ["TWILIO_ACCOUNT_SID"], os.environ["TWILIO_AUTH_TOKEN"], http_client=http_client)
+
+
+def make_twilio_calls(name=None):
+    """Builds the Twilio REST helper selected by TWILIO_PROVIDER (twilio or fake)."""
+    name = name or os.getenv("TWILIO_PROVIDER", "twilio")
+    if name == "twilio":
+        return TwilioCalls(make_twilio_client(pool_size=4))
+    if name == "fake":
+        return FakeTwilioCalls()
+    raise ValueError(f"Unknown Twilio provider {name!r}")
@@ -0,0 +1,237 @@
+import binascii
+import json
+import os
+import queue
+import threading
+import time
+import wave
+
+import numpy as np
+
+from codec import FRAME_MS, PCM_FRAME_BYTES, SAMPLE_RATE, ulaw_to_pcm
+from journal import (INBOUND_EVENT, INBOUND_MEDIA, MAGIC, OUTBOUND_EVENT, OUTBOUND_MEDIA, missing_frames,
+                     pack_record)
+
+FORMATS = ("wav", "journal")
+
+
+class CallRecording:
+    """
+    Writer-thread state of one call: a stereo WAV (left the remote agent,
+    right our replies) advanced on Twilio's inbound clock, the call's
+    journal (see journal.py) and the events written to the JSON sidecar.
+    """
+
+    def __init__(self, directory, call_sid, metadata, started, formats=("wav",)):
+        self.call_sid = call_sid
+        self.started = started  # time.monotonic() of the start event, the journal's time origin
+        self.wav_path = os.path.join(directory, f"{call_sid}.wav")
+        self.json_path = os.path.join(directory, f"{call_sid}.json")
+        self.journal_path = os.path.join(directory, f"{call_sid}.journal")
+        self.wav = None
+        if "wav" in formats:
+            self.wav = wave.open(self.wav_path, "wb")
+            self.wav.setnchannels(2)
+            self.wav.setsampwidth(2)
+            self.wav.setframerate(SAMPLE_RATE)
+        self.journal = None
+        if "journal" in formats:
+            self.journal = open(self.journal_path, "wb")
+            self.journal.write(MAGIC)
+        self.metadata = dict(metadata, started_at=time.time())
+        self.events = []
+        self.frames = 0  # stereo frames written, the recording's clock
+        self.last_timestamp = None
+        self.outbound = bytearray()  # our audio sent to Twilio and not played yet
+        self.dropped = 0
+
+    @property
+    def position(self):
+        return self.frames * FRAME_MS / 1000
+
+    def _log(self, received_at, kind, payload, timestamp=0):
+        if self.journal is not None:
+            self.journal.write(pack_record(received_at - self.started, kind, payload, timestamp))
+
+    def inbound(self, received_at, timestamp, payload):
+        ulaw = binascii.a2b_base64(payload)
+        self._log(received_at, INBOUND_MEDIA, ulaw, timestamp)
+        if self.wav is None:
+            return
+        # Frames lost upstream (or dropped by the queue) become silence so both channels stay aligned
+        for _ in range(missing_frames(self.last_timestamp, timestamp)):
+            self._write(bytes(PCM_FRAME_BYTES))
+        self.last_timestamp = timestamp
+        self._write(ulaw_to_pcm(ulaw))
+
+    def _write(self, inbound_pcm):
+        # Twilio plays our audio back to back in real time, one 20 ms frame per inbound frame
+        size = len(inbound_pcm)
+        outbound_pcm = ulaw_to_pcm(self.outbound[:size // 2])
+        del self.outbound[:size // 2]
+        stereo = np.zeros(size, dtype="<i2")
+        stereo[0::2] = np.frombuffer(inbound_pcm, dtype="<i2")
+        outbound = np.frombuffer(outbound_pcm, dtype="<i2")
+        stereo[1:2 * len(outbound):2] = outbound
+        self.wav.writeframes(stereo.tobytes())
+        self.frames += 1
+
+    def outbound_audio(self, received_at, ulaw):
+        self._log(received_at, OUTBOUND_MEDIA, ulaw)
+        if self.wav is not None:
+            self.outbound.extend(ulaw)
+
+    def message(self, received_at, outbound, raw):
+        self._log(received_at, OUTBOUND_EVENT if outbound else INBOUND_EVENT, raw)
+
+    def clear(self):
+        self.outbound.clear()
+
+    def event(self, kind, data):
+        self.events.append({"t": round(self.position, 3), "at": data.pop("at"), "type": kind, **data})
+
+    def close(self, summary):
+        if self.wav is not None:
+            self.wav.close()
+        if self.journal is not None:
+            self.journal.close()
+        sidecar = {
+            **self.metadata,
+            "wav": os.path.basename(self.wav_path) if self.wav is not None else None,
+            "journal": os.path.basename(self.journal_path) if self.journal is not None else None,
+            "duration": round(self.position, 3),
+            "dropped_messages": self.dropped,
+            "events": self.events,
+            "summary": summary,
+        }
+        with open(self.json_path, "w") as f:
+            json.dump(sidecar, f, indent=2, ensure_ascii=False)
+
+
+class Recorder:
+    """
+    Records calls from a dedicated writer thread so file I/O never runs in
+    the media loop. Every message goes through one unbounded queue, so the
+    media loop never waits on the writer, but audio only gets in while one
+    of max_queued_frames slots is free: when the disk can't keep up, frames
+    are dropped (and padded with silence in the recording) instead of
+    slowing the call down. Control messages (open, events, close) are never
+    dropped. Drops are counted per call on the producer side and handed to
+    the writer with the call's close.
+    """
+
+    def __init__(self, directory, max_queued_frames=5000, formats=("wav",)):
+        unknown = set(formats) - set(FORMATS)
+        if unknown:
+            raise ValueError(f"Unknown recording formats {sorted(unknown)}, expected some of {FORMATS}")
+        self.directory = directory
+        self.formats = tuple(formats)
+        self.journal = "journal" in formats
+        self.max_queued_frames = max_queued_frames
+        self.queue = queue.Queue()
+        self.audio_slots = threading.Semaphore(max_queued_frames)  # released by the writer
+        self.drops = {}  # call_sid -> audio messages dropped, only touched by the producer
+        self.dropped = 0  # every call's drops since startup
+        self.calls = {}  # call_sid -> CallRecording, only touched by the writer thread
+        os.makedirs(directory, exist_ok=True)
+        self.thread = threading.Thread(target=self._run, name="call-recorder", daemon=True)
+        self.thread.start()
+
+    def open(self, call_sid, **metadata):
+        self.queue.put_nowait(("open", call_sid, (time.monotonic(), metadata)))
+
+    def inbound(self, call_sid, timestamp, payload):
+        """Queues one inbound media frame (Twilio's timestamp in ms and base64 u-law payload)."""
+        self._put_audio(("inbound", call_sid, (time.monotonic(), int(timestamp), payload)))
+
+    def outbound(self, call_sid, ulaw):
+        self._put_audio(("outbound", call_sid, (time.monotonic(), bytes(ulaw))))
+
+    def message(self, call_sid, raw, outbound=False):
+        """Journals a websocket message other than media (`raw` is its JSON text or dict)."""
+        if not self.journal:
+            return
+        if not isinstance(raw, str):
+            raw = json.dumps(raw)
+        self.queue.put_nowait(("message", call_sid, (time.monotonic(), outbound, raw)))
+
+    def clear(self, call_sid):
+        """Twilio dropped the audio we had queued (barge-in)."""
+        self.queue.put_nowait(("clear", call_sid, None))
+
+    def event(self, call_sid, kind, **data):
+        self.queue.put_nowait(("event", call_sid, (kind, dict(data, at=time.time()))))
+
+    def close(self, call_sid, summary=None):
+        self.queue.put_nowait(("close", call_sid, (summary, self.drops.pop(call_sid, 0))))
+
+    def shutdown(self, timeout=5.0):
+        self.queue.put_nowait(None)
+        self.thread.join(timeout)
+
+    @property
+    def queued_frames(self):
+        """Messages waiting for the writer (approximate)."""
+        return self.queue.qsize()
+
+    def _put_audio(self, message):
+        if not self.audio_slots.acquire(blocking=False):
+            call_sid = message[1]
+            self.drops[call_sid] = self.drops.get(call_sid, 0) + 1
+            self.dropped += 1
+            return
+        self.queue.put_nowait(message)
+
+    def _run(self):
+        while True:
+            message = self.queue.get()
+            if message is None:
+                break
+            kind, call_sid, data = message
+            try:
+                self._handle(kind, call_sid, data)
+            except Exception as e:
+                print(f"[{call_sid}] Recording error: {e!r}")
+            finally:
+                if kind in ("inbound", "outbound"):
+                    self.audio_slots.release()
+        for recording in self.calls.values():
+            recording.close(None)
+        self.calls.clear()
+
+    def _handle(self, kind, call_sid, data):
+        if kind == "open":
+            if call_sid not in self.calls:
+                started, metadata = data
+                self.calls[call_sid] = CallRecording(self.directory, call_sid, metadata, started, self.formats)
+            return
+        recording = self.calls.get(call_sid)
+        if recording is None:
+            return
+        if kind == "inbound":
+            recording.inbound(*data)
+        elif kind == "outbound":
+            recording.outbound_audio(*data)
+        elif kind == "message":
+            recording.message(*data)
+        elif kind == "clear":
+            recording.clear()
+        elif kind == "event":
+            recording.event(*data)
+        elif kind == "close":
+            summary, recording.dropped = data
+            recording.close(summary)
+            del self.calls[call_sid]
+            print(f"[{call_sid}] Recording saved to {recording.json_path}")
+
+
+def make_recorder():
+    """
+    Builds a Recorder writing RECORDING_FORMATS (comma separated, wav
+    and/or journal) to RECORDINGS_DIR, or returns None when it isn't set.
+    """
+    directory = os.getenv("RECORDINGS_DIR")
+    if not directory:
+        return None
+    formats = [name.strip() for name in os.getenv("RECORDING_FORMATS", "wav").split(",") if name.strip()]
+    return Recorder(directory, max_queued_frames=int(os.getenv("RECORDING_QUEUE_FRAMES", 5000)), formats=formats)
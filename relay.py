@@ -0,0 +1,260 @@
+import asyncio
+import json
+import os
+import socket
+import time
+import uuid
+
+OWNER_TTL = 30.0  # seconds an ownership record lives without a heartbeat
+ENDED_TTL = 3600.0  # seconds a finished call is remembered, so late turns get "ended" instead of 404
+
+
+class Subscription:
+    """Messages published on one channel of a MemoryBroker."""
+
+    def __init__(self, broker, channel):
+        self.broker = broker
+        self.channel = channel
+        self.queue = asyncio.Queue()
+
+    async def get(self, timeout=None):
+        """Next message, raising asyncio.TimeoutError after `timeout` seconds."""
+        return await asyncio.wait_for(self.queue.get(), timeout=timeout)
+
+    async def close(self):
+        self.broker.channels.get(self.channel, set()).discard(self)
+
+
+class MemoryBroker:
+    """
+    In-process stand-in for RedisBroker: call ownership records with a TTL
+    plus pub/sub channels. Every "worker" sharing the instance sees the same
+    data, which is enough to exercise the relay without a Redis server.
+    """
+
+    def __init__(self):
+        self.owners = {}  # call_sid -> (worker_id, expires_at)
+        self.ended = {}  # call_sid -> expires_at of calls that finished
+        self.channels = {}  # channel -> set of Subscription
+
+    async def set_owner(self, call_sid, worker_id, ttl=OWNER_TTL):
+        self.owners[call_sid] = (worker_id, time.monotonic() + ttl)
+
+    async def get_owner(self, call_sid):
+        worker_id, expires_at = self.owners.get(call_sid, (None, 0))
+        if worker_id is not None and expires_at < time.monotonic():
+            del self.owners[call_sid]
+            return None
+        return worker_id
+
+    async def release_owner(self, call_sid, worker_id):
+        """Forgets the owner of `call_sid`, unless another worker took it over."""
+        if self.owners.get(call_sid, (None, 0))[0] == worker_id:
+            del self.owners[call_sid]
+
+    async def mark_ended(self, call_sid, ttl=ENDED_TTL):
+        now = time.monotonic()
+        self.ended = {sid: expires_at for sid, expires_at in self.ended.items() if expires_at >= now}
+        self.ended[call_sid] = now + ttl
+
+    async def has_ended(self, call_sid):
+        return self.ended.get(call_sid, 0) >= time.monotonic()
+
+    async def publish(self, channel, message):
+        for subscription in list(self.channels.get(channel, ())):
+            subscription.queue.put_nowait(message)
+
+    async def subscribe(self, channel):
+        subscription = Subscription(self, channel)
+        self.channels.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    async def close(self):
+        pass
+
+
+class RedisSubscription:
+    """Messages published on one Redis pub/sub channel."""
+
+    def __init__(self, pubsub):
+        self.pubsub = pubsub
+
+    async def get(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise asyncio.TimeoutError()
+            message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=remaining)
+            if message is not None and message["type"] == "message":
+                return json.loads(message["data"])
+
+    async def close(self):
+        await self.pubsub.aclose()
+
+
+class RedisBroker:
+    """Ownership records and pub/sub channels shared by every worker through Redis."""
+
+    RELEASE = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+    def __init__(self, url, prefix="calling-agent"):
+        try:
+            import redis.asyncio
+        except ImportError as e:
+            raise RuntimeError("SESSION_STORE=redis needs the redis package: uv pip install '.[redis]'") from e
+        self.redis = redis.asyncio.from_url(url, decode_responses=True)
+        self.prefix = prefix
+
+    def _owner_key(self, call_sid):
+        return f"{self.prefix}:owner:{call_sid}"
+
+    def _ended_key(self, call_sid):
+        return f"{self.prefix}:ended:{call_sid}"
+
+    async def set_owner(self, call_sid, worker_id, ttl=OWNER_TTL):
+        await self.redis.set(self._owner_key(call_sid), worker_id, ex=max(1, int(ttl)))
+
+    async def get_owner(self, call_sid):
+        return await self.redis.get(self._owner_key(call_sid))
+
+    async def release_owner(self, call_sid, worker_id):
+        await self.redis.eval(self.RELEASE, 1, self._owner_key(call_sid), worker_id)
+
+    async def mark_ended(self, call_sid, ttl=ENDED_TTL):
+        await self.redis.set(self._ended_key(call_sid), 1, ex=max(1, int(ttl)))
+
+    async def has_ended(self, call_sid):
+        return bool(await self.redis.exists(self._ended_key(call_sid)))
+
+    async def publish(self, channel, message):
+        await self.redis.publish(f"{self.prefix}:{channel}", json.dumps(message))
+
+    async def subscribe(self, channel):
+        pubsub = self.redis.pubsub()
+        await pubsub.subscribe(f"{self.prefix}:{channel}")
+        return RedisSubscription(pubsub)
+
+    async def close(self):
+        await self.redis.aclose()
+
+
+class Relay:
+    """
+    Lets any worker serve /generate and /turns for a call whose Twilio media
+    stream is held by another worker. The worker that receives the stream
+    claims the call in the shared store; other workers forward each turn
+    request to the owner's channel and wait for its reply on a per-request channel.
+    """
+
+    def __init__(self, broker, worker_id=None, ttl=OWNER_TTL):
+        self.broker = broker
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.ttl = ttl
+        self.claimed = set()  # calls owned by this worker
+        self.tasks = []
+
+    def start(self, handle_turn):
+        """
+        Starts serving forwarded turns with `handle_turn(request)`, which returns
+        the reply message, and refreshing the ownership of this worker's calls.
+        """
+        self.tasks = [
+            asyncio.create_task(self._serve(handle_turn)),
+            asyncio.create_task(self._heartbeat()),
+        ]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        for call_sid in list(self.claimed):
+            await self.release(call_sid)
+        await self.broker.close()
+
+    async def claim(self, call_sid):
+        self.claimed.add(call_sid)
+        await self.broker.set_owner(call_sid, self.worker_id, self.ttl)
+
+    async def release(self, call_sid):
+        """Gives up a finished call, remembering that it ended for the other workers."""
+        self.claimed.discard(call_sid)
+        try:
+            await self.broker.mark_ended(call_sid)
+            await self.broker.release_owner(call_sid, self.worker_id)
+        except Exception as e:
+            print(f"[{call_sid}] Could not release call ownership: {e!r}")
+
+    async def ended(self, call_sid):
+        """Whether any worker finished `call_sid`."""
+        try:
+            return await self.broker.has_ended(call_sid)
+        except Exception as e:
+            print(f"[{call_sid}] Could not check whether the call ended: {e!r}")
+            return False
+
+    async def find_owner(self, call_sid, wait=0.0, poll=0.05):
+        """Worker holding the call's media stream, waiting up to `wait` seconds for it to connect."""
+        deadline = time.monotonic() + wait
+        while True:
+            owner = await self.broker.get_owner(call_sid)
+            if owner is not None or time.monotonic() >= deadline:
+                return owner
+            await asyncio.sleep(poll)
+
+    async def forward(self, owner, request, timeout):
+        """Sends a turn request to `owner` and returns its reply, or None on timeout."""
+        reply_to = uuid.uuid4().hex
+        subscription = await self.broker.subscribe(f"reply:{reply_to}")
+        try:
+            await self.broker.publish(f"worker:{owner}", {**request, "reply_to": reply_to})
+            return await subscription.get(timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            await subscription.close()
+
+    async def _serve(self, handle_turn):
+        subscription = await self.broker.subscribe(f"worker:{self.worker_id}")
+        pending = set()
+        try:
+            while True:
+                request = await subscription.get()
+                task = asyncio.create_task(self._reply(handle_turn, request))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        finally:
+            for task in pending:
+                task.cancel()
+            await subscription.close()
+
+    async def _reply(self, handle_turn, request):
+        try:
+            reply = await handle_turn(request)
+        except Exception as e:
+            print(f"[{request.get('sid')}] Forwarded turn failed: {e!r}")
+            reply = {"status": 500, "detail": str(e)}
+        await self.broker.publish(f"reply:{request['reply_to']}", reply)
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            for call_sid in list(self.claimed):
+                try:
+                    await self.broker.set_owner(call_sid, self.worker_id, self.ttl)
+                except Exception as e:
+                    print(f"[{call_sid}] Could not refresh call ownership: {e!r}")
+
+
+def make_relay():
+    """
+    Builds the relay selected by SESSION_STORE: local (default, a single
+    worker and no relay), memory (in-process stand-in) or redis (REDIS_URL).
+    """
+    name = os.getenv("SESSION_STORE", "local")
+    if name == "local":
+        return None
+    if name == "memory":
+        return Relay(MemoryBroker())
+    if name == "redis":
+        return Relay(RedisBroker(os.getenv("REDIS_URL", "redis://localhost:6379/0")))
+    raise ValueError(f"Unknown session store {name!r}")
@@ -0,0 +1,176 @@
+"""
+Offline replay of call journals through the live listening pipeline.
+
+Calls recorded with RECORDINGS_DIR and RECORDING_FORMATS=journal leave a
+<call_sid>.journal with every Twilio websocket message. This tool pushes
+the remote agent's audio of each journal through listener.Listener, the
+VAD, endpointing, pre-roll and S2T code media_stream runs, as fast as the
+CPU allows and over many journals in parallel (one process per CPU), so
+VAD modes and endpointing settings can be compared on hundreds of recorded
+calls in seconds instead of placing real calls.
+
+As in the live call, audio is ignored while our reply plays, from our
+first media frame of a reply until Twilio's endOfPlayback mark (or our
+clear). Transcripts come from the fake provider unless --speech
+elevenlabs is given, which sends every utterance to ElevenLabs.
+
+    uv run python replay.py recordings/*.journal
+    uv run python replay.py recordings/*.journal --vad-mode 2 \\
+        --endpointing '{"silence_ms": 1200}' --endpointing '{"strategy": "adaptive"}'
+"""
+import argparse
+import asyncio
+import functools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from dotenv import load_dotenv
+
+from codec import FRAME_MS, PCM_FRAME_BYTES, ulaw_to_pcm
+from endpointing import DISCARD, ENDPOINT, SPEECH_START, EndpointConfig
+from journal import INBOUND_EVENT, INBOUND_MEDIA, OUTBOUND_EVENT, OUTBOUND_MEDIA, missing_frames, read_journal
+from listener import Listener
+from providers import FakeSpeech, make_speech_provider
+
+
+async def replay(path, config, vad_mode=3, speech_name="fake", incremental=True):
+    """Replays one journal and returns its utterances as endpointed with `config`."""
+    speech = FakeSpeech(stt_latency=0.0) if speech_name == "fake" else make_speech_provider(speech_name)
+    listener = Listener(speech, config, vad_mode=vad_mode)
+    silence = bytes(PCM_FRAME_BYTES)
+    playing = False
+    last_timestamp = None
+    frames = 0
+    replies = 0
+    discarded = 0
+    speech_start = None
+    utterances = []  # (utterance dict, transcript task)
+
+    for record in read_journal(path):
+        if record.kind == OUTBOUND_MEDIA:
+            playing = True
+            continue
+        if record.kind in (INBOUND_EVENT, OUTBOUND_EVENT):
+            message = record.message()
+            event = message.get("event")
+            if event == "clear" or (event == "mark" and record.kind == INBOUND_EVENT):
+                playing = False
+            elif event == "mark":
+                replies += 1
+            continue
+        if record.kind != INBOUND_MEDIA:
+            continue
+
+        pcm = ulaw_to_pcm(record.payload)
+        # Frames the recorder dropped are replayed as silence, keeping the timing
+        count = missing_frames(last_timestamp, record.timestamp) + 1
+        last_timestamp = record.timestamp
+        for i in range(count):
+            frame = pcm if i == count - 1 else silence
+            timestamp = record.timestamp - (count - 1 - i) * FRAME_MS
+            frames += 1
+            if playing:
+                listener.reset()
+                continue
+            event = listener.process(frame, incremental=incremental)
+            if event == SPEECH_START:
+                speech_start = timestamp
+            elif event == ENDPOINT:
+                utterance = listener.take()
+                pending = utterance.finish()
+                utterances.append(({
+                    "start_ms": speech_start,
+                    "endpoint_ms": timestamp,
+                    "forced": listener.endpointer.forced,
+                    "speculations": utterance.speculations,
+                    "speculative_commits": utterance.committed,
+                }, pending))
+            elif event == DISCARD:
+                listener.cancel()
+                discarded += 1
+    listener.cancel()
+
+    results = []
+    for utterance, pending in utterances:
+        try:
+            utterance["text"] = await pending
+        except Exception as e:
+            utterance["error"] = repr(e)
+        results.append(utterance)
+    return {
+        "journal": path,
+        "audio_seconds": frames * FRAME_MS / 1000,
+        "live_replies": replies,
+        "utterances": results,
+        "discarded": discarded,
+        "forced": sum(1 for utterance in results if utterance["forced"]),
+    }
+
+
+def replay_file(path, settings, vad_mode, speech_name, incremental):
+    """Process pool entry point."""
+    return asyncio.run(replay(path, EndpointConfig.from_dict(settings), vad_mode, speech_name, incremental))
+
+
+def summarize(results, seconds):
+    audio = sum(result["audio_seconds"] for result in results)
+    return {
+        "journals": len(results),
+        "audio_seconds": round(audio, 2),
+        "utterances": sum(len(result["utterances"]) for result in results),
+        "live_replies": sum(result["live_replies"] for result in results),
+        "discarded": sum(result["discarded"] for result in results),
+        "forced": sum(result["forced"] for result in results),
+        "speculations": sum(u["speculations"] for result in results for u in result["utterances"]),
+        "speculative_commits": sum(u["speculative_commits"] for result in results for u in result["utterances"]),
+        "wall_seconds": round(seconds, 2),
+        "speedup": round(audio / seconds, 1) if seconds else None,
+    }
+
+
+def main(args):
+    load_dotenv()
+    variants = [json.loads(settings) for settings in args.endpointing or ["{}"]]
+    for settings in variants:
+        EndpointConfig.from_dict(settings)  # fail before starting the workers
+    report = []
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for settings in variants:
+            start = time.perf_counter()
+            run = functools.partial(replay_file, settings=settings, vad_mode=args.vad_mode,
+                                    speech_name=args.speech, incremental=not args.buffered)
+            results = list(pool.map(run, args.journals))
+            summary = summarize(results, time.perf_counter() - start)
+            report.append({"endpointing": settings, "vad_mode": args.vad_mode, "summary": summary, "calls": results})
+            if args.verbose:
+                for result in results:
+                    print(f"{os.path.basename(result['journal'])}: {len(result['utterances'])} utterances, "
+                          f"{result['live_replies']} live replies, {result['discarded']} discarded")
+                    for utterance in result["utterances"]:
+                        print(f"  {utterance['start_ms'] / 1000:7.2f}-{utterance['endpoint_ms'] / 1000:7.2f}s "
+                              f"{utterance.get('text', utterance.get('error'))}")
+            print(f"endpointing={json.dumps(settings)} vad_mode={args.vad_mode} " + " ".join(
+                f"{name}={value}" for name, value in summary.items()))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("journals", nargs="+", help="call journals to replay")
+    parser.add_argument("--endpointing", action="append",
+                        help="endpointing settings (JSON), repeat to compare several; defaults to EndpointConfig()")
+    parser.add_argument("--vad-mode", type=int, default=3, choices=range(4), help="webrtcvad aggressiveness")
+    parser.add_argument("--speech", default="fake", help="speech provider for S2T (fake or elevenlabs)")
+    parser.add_argument("--buffered", action="store_true", help="transcribe whole utterances (stream_stt off)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="replay processes")
+    parser.add_argument("--verbose", action="store_true", help="print every utterance")
+    parser.add_argument("--json", help="write every utterance of every variant to this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,57 @@
+class RingBuffer:
+    """
+    Fixed-capacity byte buffer allocated once and reused, so the audio kept
+    per call doesn't grow with the length of an utterance. Once full, new
+    data overwrites the oldest bytes.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = bytearray(capacity)
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def full(self):
+        return self.size == self.capacity
+
+    def extend(self, chunk):
+        chunk = memoryview(chunk).cast("B")
+        n = len(chunk)
+        if n >= self.capacity:
+            self.data[:] = chunk[n - self.capacity:]
+            self.start = 0
+            self.size = self.capacity
+            return
+        end = (self.start + self.size) % self.capacity
+        first = min(n, self.capacity - end)
+        self.data[end:end + first] = chunk[:first]
+        self.data[:n - first] = chunk[first:]
+        overflow = self.size + n - self.capacity
+        if overflow > 0:
+            self.start = (self.start + overflow) % self.capacity
+            self.size = self.capacity
+        else:
+            self.size += n
+
+    def getvalue(self):
+        """Copies the buffered bytes out, oldest first."""
+        end = self.start + self.size
+        view = memoryview(self.data)
+        if end <= self.capacity:
+            return bytes(view[self.start:end])
+        return b"".join((view[self.start:], view[:end - self.capacity]))
+
+    def clear(self):
+        self.start = 0
+        self.size = 0
+
+
+def reserve(buffer, capacity):
+    """Returns `buffer` if it is exactly `capacity` bytes, else a new RingBuffer of that size."""
+    if buffer is not None and buffer.capacity == capacity:
+        return buffer
+    return RingBuffer(capacity)
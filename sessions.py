@@ -0,0 +1,215 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from endpointing import EndpointConfig
+from metrics import summarize_turns, turn_spans
+
+
+# Turn states of a call. The remote agent talks while we are LISTENING, its
+# utterance is converted to text while TRANSCRIBING, then /generate hands us
+# the simulated user's reply (AWAITING_INPUT), we play it (SPEAKING) and wait
+# for Twilio to confirm playback finished (AWAITING_MARK) before listening again.
+# With barge-in the agent may interrupt our playback, going straight back to LISTENING.
+LISTENING = "listening"
+TRANSCRIBING = "transcribing"
+AWAITING_INPUT = "awaiting_input"
+SPEAKING = "speaking"
+AWAITING_MARK = "awaiting_mark"
+ENDED = "ended"
+
+TRANSITIONS = {
+    LISTENING: {TRANSCRIBING, ENDED},
+    TRANSCRIBING: {LISTENING, AWAITING_INPUT, ENDED},
+    AWAITING_INPUT: {SPEAKING, ENDED},
+    SPEAKING: {AWAITING_MARK, LISTENING, ENDED},
+    AWAITING_MARK: {LISTENING, ENDED},
+    ENDED: set(),
+}
+
+CONVERSATION_ENDED = "Conversation ended by Twilio"
+
+
+class CallSession:
+    """
+    Holds the conversation state of a single phone call so that one server
+    process can drive several calls at the same time.
+
+    Turn handoff is an explicit state machine: transcripts and user inputs
+    travel through queues so the waiting coroutine wakes up as soon as the
+    other side produces a value.
+    """
+
+    def __init__(self, call_sid, talk_timeout=50.0, stream_tts=True, stream_stt=True, endpointing=None, barge_in=False):
+        self.call_sid = call_sid
+        self.stream_sid = None
+        self.created = time.monotonic()
+        self.state = LISTENING
+        self.transitions = [(LISTENING, time.time())]  # (state, timestamp) history of the call
+        self.transcripts = asyncio.Queue()  # agent utterances, consumed by /generate
+        self.inputs = asyncio.Queue()  # simulated user replies, consumed by send_to_twilio
+        self.time_since_last_talk = time.time()
+        self.talk_timeout = talk_timeout
+        self.stream_tts = stream_tts  # send TTS to Twilio frame by frame as it is synthesized
+        self.stream_stt = stream_stt  # transcribe the remote party incrementally while they speak
+        self.endpointing = endpointing or EndpointConfig()  # end-of-turn detection settings
+        self.barge_in = barge_in  # keep listening while our reply plays and stop it if the agent talks over it
+        self.shutdown_event = asyncio.Event()
+        self.turn_marks = {}  # monotonic timestamps of the current turn's events, see metrics.SPANS
+        self.turns = []  # span durations of the finished turns
+
+    @property
+    def listening(self):
+        """Whether inbound audio belongs to the agent's current turn."""
+        return self.state in (LISTENING, TRANSCRIBING)
+
+    @property
+    def playing(self):
+        """Whether our reply is being sent or played to the agent."""
+        return self.state in (SPEAKING, AWAITING_MARK)
+
+    def transition(self, state):
+        """Moves to `state`, returning False (and staying put) if the move is not allowed."""
+        if state == self.state:
+            return True
+        if state not in TRANSITIONS[self.state]:
+            print(f"[{self.call_sid}] Ignoring invalid turn transition {self.state} -> {state}")
+            return False
+        self.state = state
+        self.transitions.append((state, time.time()))
+        return True
+
+    def publish_transcript(self, text):
+        """Hands the agent's utterance to /generate, unless the turn already moved on."""
+        if not self.listening:
+            print(f"[{self.call_sid}] Dropping late transcript: {text}")
+            return False
+        self.transition(AWAITING_INPUT)
+        self.transcripts.put_nowait(text)
+        return True
+
+    def submit_input(self, text):
+        """Queues the simulated user's reply for playback."""
+        if self.state != AWAITING_INPUT:
+            return False
+        self.transition(SPEAKING)
+        self.mark("input_received", overwrite=True)
+        self.inputs.put_nowait(text)
+        return True
+
+    def interrupt(self):
+        """The agent barged in on our reply: the rest of it is dropped and we listen again."""
+        if not self.playing:
+            return False
+        self.mark("barge_in")
+        return self.transition(LISTENING)
+
+    def mark(self, event, overwrite=False):
+        """Records when `event` happened in the current turn (first occurrence unless overwrite)."""
+        if overwrite or event not in self.turn_marks:
+            self.turn_marks[event] = time.monotonic()
+
+    def finish_turn(self):
+        """Closes the current turn and returns its span durations."""
+        spans = turn_spans(self.turn_marks)
+        self.turns.append({"spans": {name: round(value, 4) for name, value in spans.items()}})
+        self.turn_marks = {}
+        return spans
+
+    def summary(self):
+        """Per-call timing summary served by /calls/{sid}."""
+        return {
+            "call_sid": self.call_sid,
+            "stream_sid": self.stream_sid,
+            "state": self.state,
+            "transitions": [{"state": state, "at": at} for state, at in self.transitions],
+            "turns": self.turns,
+            "spans": summarize_turns(self.turns),
+        }
+
+    def end(self):
+        """Ends the conversation, waking up /generate with the end message."""
+        if self.state != ENDED:
+            self.transition(ENDED)
+            self.transcripts.put_nowait(CONVERSATION_ENDED)
+        self.shutdown()
+
+    def shutdown(self):
+        """Flags the call as finished so both media coroutines stop."""
+        if not self.shutdown_event.is_set():
+            self.shutdown_event.set()
+            self.inputs.put_nowait(None)  # wakes up send_to_twilio
+            print(f"[{self.call_sid}] Shutdown requested")
+
+    def __repr__(self):
+        return f"CallSession(call_sid={self.call_sid!r}, stream_sid={self.stream_sid!r}, state={self.state!r})"
+
+
+class SessionRegistry:
+    """
+    Keeps track of the live calls handled by this process, indexed both by
+    Twilio call SID (used by /generate) and by media stream SID.
+    """
+
+    def __init__(self, keep_finished=200):
+        self._by_call = {}
+        self._by_stream = {}
+        self.finished = OrderedDict()  # summaries of the last ended calls
+        self.keep_finished = keep_finished
+
+    def get_or_create(self, call_sid, **kwargs):
+        session = self._by_call.get(call_sid)
+        if session is None:
+            session = CallSession(call_sid, **kwargs)
+            self._by_call[call_sid] = session
+            print(f"[{call_sid}] Session created ({len(self._by_call)} active)")
+        return session
+
+    def get(self, call_sid):
+        return self._by_call.get(call_sid)
+
+    def ended(self, call_sid):
+        """Whether `call_sid` is a call this process already finished."""
+        return call_sid not in self._by_call and call_sid in self.finished
+
+    def get_by_stream(self, stream_sid):
+        return self._by_stream.get(stream_sid)
+
+    def bind_stream(self, session, stream_sid):
+        """Associates a Twilio media stream with an existing call session."""
+        session.stream_sid = stream_sid
+        self._by_stream[stream_sid] = session
+
+    def remove(self, call_sid):
+        session = self._by_call.pop(call_sid, None)
+        if session is not None:
+            if session.stream_sid is not None:
+                self._by_stream.pop(session.stream_sid, None)
+            self.finished[call_sid] = session.summary()
+            while len(self.finished) > self.keep_finished:
+                self.finished.popitem(last=False)
+            print(f"[{call_sid}] Session removed ({len(self._by_call)} active)")
+        return session
+
+    def expire(self, ttl):
+        """
+        Ends and removes the sessions created more than `ttl` seconds ago that
+        no media stream ever joined, e.g. a /generate for a call that was never
+        answered. Returns how many were removed.
+        """
+        now = time.monotonic()
+        expired = [
+            session for session in self._by_call.values()
+            if session.stream_sid is None and now - session.created > ttl
+        ]
+        for session in expired:
+            print(f"[{session.call_sid}] No media stream after {ttl:.0f}s, ending the session")
+            session.end()
+            self.remove(session.call_sid)
+        return len(expired)
+
+    def all(self):
+        return list(self._by_call.values())
+
+    def __len__(self):
+        return len(self._by_call)
@@ -3,13 +3,21 @@ import requests
 import json
 import signal
 from dotenv import load_dotenv
-from twilio.rest import Client
 from galtea import Galtea
+from requests.adapters import HTTPAdapter
 import os,uuid,time
+import queue
+import threading
+import traceback
 import yaml
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from websockets.exceptions import ConnectionClosed, InvalidHandshake
+from websockets.sync.client import connect
+from providers import make_twilio_client
 
 load_dotenv()
-sid = None
+active_agents = set()  # agents with a call in progress, hung up on SIGINT/SIGTERM
+active_agents_lock = threading.Lock()
 
 def load_config(path="config.yaml"):
     try:
@@ -20,12 +28,57 @@ def load_config(path="config.yaml"):
         return {}
 
 config = load_config()
+http = requests.Session()  # keep-alive connections to the server for the HTTP turn fallback
+
+
+class CallError(Exception):
+    """Raised when a simulated call can't continue; fails only its own test case."""
+
+
+class TurnChannel:
+    """
+    Client side of the server's /turns websocket: a single connection per call
+    over which the user replies are pushed and the agent transcripts arrive.
+    """
+    def __init__(self, base_url, headers):
+        self.url = "ws" + base_url[len("http"):] + "/turns" if base_url.startswith("http") else base_url + "/turns"
+        self.headers = headers
+        self.ws = None
+        self.ended = False  # the server said the conversation is over
+
+    def open(self, start):
+        self.ws = connect(self.url, additional_headers=self.headers, open_timeout=10)
+        self.ws.send(json.dumps({"type": "start", **start}))
+
+    def send_input(self, text):
+        self.ws.send(json.dumps({"type": "input", "text": text}))
+
+    def receive(self, timeout, first=False):
+        """
+        Returns the next transcript or end-of-call message, raising TimeoutError.
+        An error answering the start message means the call was rejected and
+        raises CallError, as a 400 does over HTTP.
+        """
+        while True:
+            msg = json.loads(self.ws.recv(timeout=timeout))
+            if msg["type"] == "error":
+                if first:
+                    raise CallError(f"Turn channel rejected the call: {msg['detail']}")
+                print("Turn channel error:", msg["detail"])
+                continue
+            if msg["type"] == "ended":
+                self.ended = True
+            return msg
+
+    def close(self):
+        if self.ws is not None:
+            self.ws.close()
+            self.ws = None
+
 
 class MyAgent(galtea.Agent):
-    def __init__(self,remote_url,from_number,to_number,base_url,asycio_timeout=120.0,request_timeout=120.0,talk_timeout=80):
-        account_sid = os.environ["TWILIO_ACCOUNT_SID"]
-        auth_token = os.environ["TWILIO_AUTH_TOKEN"]
-        self.client = Client(account_sid, auth_token)
+    def __init__(self,remote_url,from_number,to_number,base_url,asycio_timeout=120.0,request_timeout=120.0,talk_timeout=80,stream_tts=True,stream_stt=True,endpointing=None,turn_channel="websocket",barge_in=False):
+        self.client = twilio_client  # shared by every agent, keeps its connections warm
         API_KEY = os.environ["API_KEY"] 
         self.BASE_URL = base_url
         self.headers = { "x-api-key": API_KEY, "Content-Type": "application/json" }
@@ -35,7 +88,12 @@ class MyAgent(galtea.Agent):
         self.asycio_timeout = asycio_timeout
         self.request_timeout = request_timeout
         self.talk_timeout = talk_timeout
-        self.sid = None
+        self.stream_tts = stream_tts
+        self.stream_stt = stream_stt
+        self.endpointing = endpointing
+        self.barge_in = barge_in
+        self.channel = TurnChannel(base_url, self.headers) if turn_channel == "websocket" else None
+        self.call_twilio = None
         self.conversation_ended = False
 
     def start_call(self):
@@ -45,31 +103,61 @@ class MyAgent(galtea.Agent):
             to=self.to_number,
             url=f"{self.remote_url}/twilio-voice",
         )
-        print(f"Call started with sid: {self.call_twilio.sid}")
-        global sid
-        sid = self.call_twilio.sid
+        print(f"Call started with sid: {self.call_twilio.sid} (from {self.from_number})")
+        with active_agents_lock:
+            active_agents.add(self)
 
     def end_call(self):
-        self.client.calls(f"{self.call_twilio.sid}").update(status='completed')
+        with active_agents_lock:
+            active_agents.discard(self)
+        if self.channel is not None:
+            self.channel.close()
+        if self.call_twilio is not None:
+            self.client.calls(f"{self.call_twilio.sid}").update(status='completed')
 
     def generate_(self,first, timeout, input):
-        params_first_call = {"client":self.client, "sid": self.call_twilio.sid, "first": first,  "timeout": timeout, "input": input, "talk_timeout": self.talk_timeout }
+        if self.channel is not None:
+            try:
+                return self.generate_channel(first, timeout, input)
+            except (InvalidHandshake, OSError) as e:
+                if not first:
+                    raise
+                print(f"Turn channel unavailable ({e}), falling back to HTTP.")
+                self.channel = None
+        return self.generate_http(first, timeout, input)
+
+    def generate_channel(self, first, timeout, input):
+        if first:
+            start = {"sid": self.call_twilio.sid, "talk_timeout": self.talk_timeout, "stream_tts": self.stream_tts, "stream_stt": self.stream_stt, "barge_in": self.barge_in }
+            if self.endpointing:
+                start["endpointing"] = self.endpointing
+            self.channel.open(start)
         try:
-            response_first = requests.get( f"{self.BASE_URL}/generate",  headers=self.headers, params=params_first_call, timeout=self.request_timeout )
-            if response_first.status_code == 200:
-                return response_first.json()
-            elif response_first.status_code == 204:
-                print("Response: No content (Timeout reached, no user speech detected). Exiting main script.")
-                exit(0)
-            else:
-                print("Error Response:", response_first.text)
-                print("Exiting main script.")
-                exit(0)
+            if not first:
+                self.channel.send_input(input)
+            msg = self.channel.receive(timeout, first=first)
+        except TimeoutError:
+            raise CallError("No content (Timeout reached, no user speech detected)")
+        except ConnectionClosed as e:
+            if self.channel.ended:
+                return {"response": "Conversation ended by Twilio"}
+            raise CallError(f"Turn channel closed before the conversation ended: {e}") from e
+        return {"response": msg["text"]}
 
+    def generate_http(self,first, timeout, input):
+        params_first_call = {"sid": self.call_twilio.sid, "first": first,  "timeout": timeout, "input": input, "talk_timeout": self.talk_timeout, "stream_tts": self.stream_tts, "stream_stt": self.stream_stt, "barge_in": self.barge_in }
+        if first and self.endpointing:
+            params_first_call["endpointing"] = json.dumps(self.endpointing)
+        try:
+            response_first = http.get( f"{self.BASE_URL}/generate",  headers=self.headers, params=params_first_call, timeout=self.request_timeout )
         except requests.exceptions.RequestException as e:
-            print(f"An error occurred: {e}")
-            print("Exiting main script.")
-            exit(0)
+            raise CallError(f"An error occurred: {e}") from e
+        if response_first.status_code == 200:
+            return response_first.json()
+        elif response_first.status_code == 204:
+            raise CallError("No content (Timeout reached, no user speech detected)")
+        else:
+            raise CallError(f"Error Response: {response_first.text}")
 
     def call(self, input_data: galtea.AgentInput) -> galtea.AgentResponse:
 
@@ -98,14 +186,16 @@ def shutdown_handler(signum, frame):
     It will be executed when this script receives SIGINT or SIGTERM.
     """
     print(f"\nCaught signal {signum}. Initiating graceful shutdown...")
-    if sid:
-        account_sid = os.environ["TWILIO_ACCOUNT_SID"]
-        auth_token = os.environ["TWILIO_AUTH_TOKEN"]
-        client = Client(account_sid, auth_token)
-        client.calls(f"{agent.call_twilio.sid}").update(status='completed')
-        print(" Twilio call status updated to completed")
+    with active_agents_lock:
+        agents = list(active_agents)
+    for agent in agents:
+        try:
+            agent.end_call()
+            print(f" Twilio call {agent.call_twilio.sid} status updated to completed")
+        except Exception as e:
+            print(f" Could not end call {agent.call_twilio.sid}: {e}")
     print("Exiting main script.")
-    exit(0)
+    os._exit(0)  # worker threads are blocked on network calls, don't wait for them
 
 for sig in (signal.SIGTERM, signal.SIGINT):
     signal.signal(sig, shutdown_handler)
@@ -122,24 +212,54 @@ if isinstance(tests_cfg, str):
 else:
     test_case_num = tests_cfg
 
+# Each concurrent call needs its own caller id, so parallelism is capped by the number pool
+from_numbers = config.get("from_numbers") or [config.get("from_number")]
+concurrency = max(1, min(int(config.get("concurrency", 1)), len(from_numbers)))
+case_delay = float(config.get("case_delay", 2.0))
+free_numbers = queue.Queue()
+for number in from_numbers:
+    free_numbers.put(number)
 
-results = []
-for i, test_case in enumerate(test_cases):
-    if i in test_case_num:
+# One keep-alive pool per host, big enough for every concurrent call
+http.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=concurrency))
+http.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=concurrency))
+twilio_client = make_twilio_client(pool_size=concurrency + 1)  # +1 for the shutdown handler
 
-        time.sleep(2)
+
+def warm_up_clients():
+    """Opens the connections to the server and to Twilio before the first call is placed."""
+    try:
+        http.get(f"{config.get('base_url', 'http://localhost:8001')}/health", timeout=10)
+    except requests.exceptions.RequestException as e:
+        print(f"Could not reach the server: {e}")
+    try:
+        twilio_client.api.v2010.accounts(os.environ["TWILIO_ACCOUNT_SID"]).fetch()
+    except Exception as e:
+        print(f"Could not reach Twilio: {e}")
+
+
+def run_test_case(i, test_case):
+    """Simulates one test case on a free from_number; errors only fail this case."""
+    from_number = free_numbers.get()
+    agent = None
+    try:
+        time.sleep(case_delay)
         agent = MyAgent(
         remote_url=config.get("remote_url"),
-        from_number=config.get("from_number"),
+        from_number=from_number,
         to_number=config.get("to_number"),
         base_url=config.get("base_url", "http://localhost:8001"),
         asycio_timeout=float(config.get("asycio_timeout", 120.0)),
         request_timeout=float(config.get("request_timeout", 120.0)),
-        talk_timeout=int(config.get("talk_timeout", 80))
+        talk_timeout=int(config.get("talk_timeout", 80)),
+        stream_tts=bool(config.get("stream_tts", True)),
+        stream_stt=bool(config.get("stream_stt", True)),
+        endpointing=config.get("endpointing"),
+        turn_channel=config.get("turn_channel", "websocket"),
+        barge_in=bool(config.get("barge_in", False))
         )
         uid = str(uuid.uuid4())
 
-
         # Create a session for this test case
         session = galtea_client.sessions.create(
             version_id=config.get("version_id"),
@@ -154,15 +274,64 @@ for i, test_case in enumerate(test_cases):
             max_turns=int(config.get("max_turns", 12)),
             agent_goes_first=bool(config.get("agent_goes_first", True))
         )
-        print("call ended")
+        print(f"[test {i}] call ended. Completed {result.total_turns} turns. Finished: {result.finished}")
+        if result.stopping_reason:
+            print(f"[test {i}] Stopping reason: {result.stopping_reason}")
+        return {"test": i, "test_case_id": test_case.id, "result": result, "error": None}
+    except Exception as e:
+        print(f"[test {i}] failed: {e}")
+        traceback.print_exc()
+        return {"test": i, "test_case_id": test_case.id, "result": None, "error": str(e)}
+    finally:
+        if agent is not None:
+            try:
+                agent.end_call()
+            except Exception as e:
+                print(f"[test {i}] Could not end call: {e}")
+        free_numbers.put(from_number)
 
-        agent.end_call()
-        results.append(result)
 
-        # Review results
-        print(f"Completed {result.total_turns} turns. Finished: {result.finished}")
-        if result.stopping_reason:
-            print(f"Stopping reason: {result.stopping_reason}")
-        # break 
+def prewarm_tts(test_cases):
+    """
+    Has the server synthesize the user lines known before dialing (each test
+    case's first message plus config's prewarm_phrases) into its TTS cache.
+    """
+    texts = list(config.get("prewarm_phrases") or [])
+    for test_case in test_cases:
+        texts += [text for text in (test_case.initial_prompt, test_case.input) if text]
+    if not texts:
+        return
+    try:
+        response = http.post(
+            f"{config.get('base_url', 'http://localhost:8001')}/tts/prewarm",
+            headers={"x-api-key": os.environ["API_KEY"]},
+            json={"texts": texts},
+            timeout=float(config.get("request_timeout", 120.0)),
+        )
+        response.raise_for_status()
+        print(f"TTS cache pre-warmed: {response.json()}")
+    except requests.exceptions.RequestException as e:
+        print(f"Could not pre-warm the TTS cache, continuing without it: {e}")
+
+
+selected = [(i, test_case) for i, test_case in enumerate(test_cases) if i in test_case_num]
+warm_up_clients()
+if config.get("prewarm_tts", False):
+    prewarm_tts([test_case for _, test_case in selected])
+print(f"Running {len(selected)} test cases with {concurrency} concurrent calls")
+
+results = []
+with ThreadPoolExecutor(max_workers=concurrency) as pool:
+    futures = [pool.submit(run_test_case, i, test_case) for i, test_case in selected]
+    for future in as_completed(futures):
+        results.append(future.result())
 
-        
\ No newline at end of file
+# Review results
+results.sort(key=lambda r: r["test"])
+failed = [r for r in results if r["error"]]
+for r in results:
+    if r["error"]:
+        print(f"test {r['test']} ({r['test_case_id']}): FAILED - {r['error']}")
+    else:
+        print(f"test {r['test']} ({r['test_case_id']}): {r['result'].total_turns} turns, finished: {r['result'].finished}")
+print(f"{len(results) - len(failed)}/{len(results)} test cases completed without errors")
@@ -0,0 +1,104 @@
+import asyncio
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+FORMAT = "ulaw_8000"  # what the cache stores: Twilio-ready 8 kHz u-law, padded to whole 20 ms frames
+
+
+class TTSCache:
+    """
+    Synthesized user turns, stored as ready-to-send u-law audio. A bounded
+    in-memory LRU sits in front of an optional directory on disk so entries
+    survive restarts and are shared by every worker using the same directory.
+    """
+
+    def __init__(self, directory=None, max_memory_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_memory_bytes = max_memory_bytes
+        self.memory = OrderedDict()  # key -> u-law bytes, least recently used first
+        self.memory_bytes = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(text, voice):
+        """Cache key of `text` spoken with `voice` (the provider's voice_key())."""
+        payload = json.dumps([FORMAT, text.strip(), voice], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.ulaw")
+
+    def _remember(self, key, audio):
+        if len(audio) > self.max_memory_bytes:
+            return
+        previous = self.memory.pop(key, None)
+        if previous is not None:
+            self.memory_bytes -= len(previous)
+        self.memory[key] = audio
+        self.memory_bytes += len(audio)
+        while self.memory_bytes > self.max_memory_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+
+    def _read(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write(self, key, audio):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(audio)
+        os.replace(tmp_path, path)  # atomic, readers never see a partial file
+
+    async def get(self, key):
+        """Returns the cached audio or None. Disk reads run off the event loop."""
+        audio = self.memory.get(key)
+        if audio is not None:
+            self.memory.move_to_end(key)
+        elif self.directory:
+            try:
+                audio = await asyncio.to_thread(self._read, key)
+            except OSError as e:
+                print(f"Error reading TTS cache: {e}")
+            if audio is not None:
+                self._remember(key, audio)
+        return audio
+
+    async def contains(self, key):
+        """Whether `key` is cached, without loading it."""
+        if key in self.memory:
+            return True
+        if not self.directory:
+            return False
+        return await asyncio.to_thread(os.path.exists, self._path(key))
+
+    async def put(self, key, audio):
+        if not audio:
+            return
+        self._remember(key, audio)
+        if self.directory:
+            try:
+                await asyncio.to_thread(self._write, key, audio)
+            except OSError as e:
+                print(f"Error writing TTS cache: {e}")
+
+
+def make_tts_cache():
+    """
+    Builds the cache from TTS_CACHE_DIR (empty for memory only) and
+    TTS_CACHE_MEMORY_MB, or returns None when TTS_CACHE=off.
+    """
+    if os.getenv("TTS_CACHE", "on").lower() in ("off", "0", "false", "no"):
+        return None
+    return TTSCache(
+        directory=os.getenv("TTS_CACHE_DIR", "tts_cache") or None,
+        max_memory_bytes=int(float(os.getenv("TTS_CACHE_MEMORY_MB", 64)) * 1024 * 1024),
+    )